@@ -7,9 +7,21 @@ import pathlib
 import unidecode
 import time
 import zipfile
+import random
+import threading
+import sqlite3
+import pickle
+import hashlib
+import argparse
+import multiprocessing
+from io import BytesIO
+from collections.abc import Mapping
+from pandas.api.types import union_categoricals
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from tenacity import *
 from datetime import datetime
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.utils.dataframe import dataframe_to_rows
@@ -20,8 +32,15 @@ from openpyxl.worksheet.views import Pane
 import gspread
 from google.oauth2 import service_account
 from pydrive import auth, drive
+from googleapiclient.http import MediaUpload
 pd.options.mode.chained_assignment = None
 
+# orjson parses Redash payloads much faster, use it when installed
+try:
+    import orjson as fast_json
+except ImportError:
+    fast_json = json
+
 # COMMON FUNCTION
 # ==================================================================
 def connect_drive(bi_key, auth, drive, gspread):
@@ -36,156 +55,870 @@ def connect_drive(bi_key, auth, drive, gspread):
     return gc, drive
 
 def get_li_files(drive, parents_id):
-    return drive.ListFile(
+    return drive_call(lambda: drive.ListFile(
         {'q' : f"'{parents_id}' in parents and trashed=false"}
-    ).GetList()
+    ).GetList())
+
+class FrameAccumulator:
+    """
+    Collect dataframes in a list and concat them once at the end,
+    instead of calling pd.concat in a loop (which copies the growing frame every time)
+    """
+    def __init__(self):
+        self.frames = []
+
+    def append(self, df):
+        self.frames.append(df)
+
+    def __len__(self):
+        # number of rows collected
+        return sum(df.shape[0] for df in self.frames)
+
+    def concat(self, **kwargs) -> pd.DataFrame:
+        if not self.frames:
+            return pd.DataFrame()
+        return pd.concat(self.frames, **kwargs)
+
+# Google API quota: requests allowed per 100 seconds, shared by all threads
+DRIVE_QUOTA = 1000
+SHEETS_QUOTA = 300
+# Max requests sent at once after being idle
+API_BURST = 20
+# Retries of a request rejected by quota, waiting 1, 2, 4.. (max 64) seconds in between
+QUOTA_RETRIES = 8
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED', 'RESOURCE_EXHAUSTED')
+
+class TokenBucket:
+    """
+    Rate limiter shared by all threads
+    Tokens are added at quota/100 per second up to `capacity`; take() waits until a token is available
+    Counters:
+    - throttled: seconds spent waiting for a token
+    - backoff, retries: seconds spent backing off / number of retries after quota errors
+    """
+    def __init__(self, name, quota, capacity=API_BURST):
+        self.name = name
+        self.rate = quota / 100
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.backoff = 0
+        self.retries = 0
+
+    def take(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve n tokens, wait outside the lock until they are refilled
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+            if wait > 0:
+                self.throttled += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def add_backoff(self, seconds):
+        with self.lock:
+            self.backoff += seconds
+            self.retries += 1
+
+    def report(self):
+        print(f'{self.name} API: throttled {self.throttled:.1f}s, '
+              f'backoff {self.backoff:.1f}s after {self.retries} quota errors')
+
+drive_limiter = TokenBucket('Drive', DRIVE_QUOTA)
+sheets_limiter = TokenBucket('Sheets', SHEETS_QUOTA)
+
+def is_quota_error(e):
+    # PyDrive raises ApiRequestError(HttpError) - status in resp.status, reason in content
+    # gspread raises APIError - status in response.status_code, reason in its message
+    for err in (e, *e.args):
+        status = getattr(getattr(err, 'resp', None), 'status', None) or \
+            getattr(getattr(err, 'response', None), 'status_code', None)
+        if status is not None:
+            detail = str(err) + str(getattr(err, 'content', ''))
+            return int(status) == 429 or (int(status) == 403 and any(r in detail for r in QUOTA_REASONS))
+    return False
+
+def count_backoff(retry_state):
+    retry_state.args[0].add_backoff(retry_state.next_action.sleep)
+
+@retry(retry=retry_if_exception(is_quota_error), wait=wait_random_exponential(multiplier=1, max=64),
+       stop=stop_after_attempt(QUOTA_RETRIES), before_sleep=count_backoff, reraise=True)
+def google_call(limiter, func, *args, **kwargs):
+    """
+    Send one Drive/Sheets request within the quota:
+    - take a token from limiter before the request
+    - retry with exponential backoff when the request is rejected by quota (403 rateLimitExceeded / 429)
+
+    Input: limiter, function sending the request and its arguments
+
+    Output: result of func
+    """
+    limiter.take()
+    return func(*args, **kwargs)
+
+def drive_call(func, *args, **kwargs):
+    return google_call(drive_limiter, func, *args, **kwargs)
+
+def sheets_call(func, *args, **kwargs):
+    return google_call(sheets_limiter, func, *args, **kwargs)
+
+# Max folders OR-ed in one files.list query, keeps the query under the URL length limit
+INDEX_PARENTS_PER_QUERY = 50
+INDEX_FIELDS = 'nextPageToken,items(id,title,parents(id),createdDate,properties(key,value))'
+
+def list_pages(file_list):
+    # Send one request (and take one token) per page, so a page rejected by quota is retried alone
+    li_files = []
+    for page in iter(lambda: drive_call(next, file_list, None), None):
+        li_files.extend(page)
+    return li_files
+
+class DriveIndex:
+    """
+    Files in many Drive folders, listed in bulk and cached for the run
+    - load(): list children of INDEX_PARENTS_PER_QUERY folders per files.list query,
+      a query which fails is sent again for each of its folders, folders which still fail are left out
+    - get(): children of one folder, listed on first use if the folder was not loaded
+    - add()/remove(): keep the cache in sync with files uploaded/deleted during the run
+    Only id, title, parents, createdDate and properties of the files are fetched
+    """
+    def __init__(self, drive):
+        self.drive = drive
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def list_children(self, chunk):
+        # list files of the folders in chunk with one query, raise if any page fails
+        q = ' or '.join(f"'{i}' in parents" for i in chunk)
+        li_files = list_pages(self.drive.ListFile(
+            {'q': f"({q}) and trashed=false", 'fields': INDEX_FIELDS, 'maxResults': 1000}))
+
+        children = {i: [] for i in chunk}
+        for file in li_files:
+            for parent in file['parents']:
+                if parent['id'] in children:
+                    children[parent['id']].append(file)
+        with self.lock:
+            self.children.update(children)
+
+    def load(self, li_parents_id):
+        li_parents_id = [i for i in dict.fromkeys(li_parents_id) if i not in self.children]
+        for k in range(0, len(li_parents_id), INDEX_PARENTS_PER_QUERY):
+            chunk = li_parents_id[k:k + INDEX_PARENTS_PER_QUERY]
+            try:
+                self.list_children(chunk)
+            except Exception as e:
+                # a failed page or one bad folder id fails the whole query:
+                # list the folders of the chunk one at a time so only the bad ones are missing
+                print(e)
+                print(f'Error when listing {len(chunk)} folders, listing them one by one')
+                for parents_id in chunk:
+                    try:
+                        self.list_children([parents_id])
+                    except Exception as e:
+                        print(e)
+                        print(f'Error when listing folder {parents_id}')
+
+    def get(self, parents_id):
+        # raise if the folder cannot be listed
+        if parents_id not in self.children:
+            self.list_children([parents_id])
+        with self.lock:
+            return list(self.children[parents_id])
+
+    def add(self, parents_id, file):
+        with self.lock:
+            if parents_id in self.children:
+                self.children[parents_id].append(file)
+
+    def remove(self, parents_id, file_id):
+        with self.lock:
+            if parents_id in self.children:
+                self.children[parents_id] = [file for file in self.children[parents_id] if file['id'] != file_id]
+
+# Max deletions sent in one batch request (Drive allows 100)
+DELETE_BATCH_SIZE = 100
+
+def is_retryable_error(e):
+    # quota errors and Drive server errors (500, 502, 503..) may succeed when sent again later
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    return is_quota_error(e) or (status is not None and int(status) >= 500)
+
+def batch_delete_files(drive, li_file_id):
+    """
+    Delete files with batch requests of DELETE_BATCH_SIZE deletions, instead of one request per file
+    - every deletion in a batch has its own result, only the failed ones are sent again
+      (with exponential backoff) when they were rejected by quota or a server error
+    - a file which was already deleted (404) counts as deleted
+    PyDrive builds a Drive v2 service, so v2 files.delete requests are batched
+
+    Input: drive, list of file id
+
+    Output: dictionary of {file id: exception} of files which could not be deleted
+    """
+    if drive.auth.service is None:
+        drive.auth.Authorize()
+    service = drive.auth.service
+
+    li_file_id = list(dict.fromkeys(li_file_id))
+    failed = {}
+    for attempt in range(QUOTA_RETRIES):
+        # result of files sent again replaces their previous error
+        for file_id in li_file_id:
+            failed.pop(file_id, None)
+
+        def callback(request_id, response, exception):
+            if exception is not None and getattr(getattr(exception, 'resp', None), 'status', None) != 404:
+                failed[request_id] = exception
+
+        for k in range(0, len(li_file_id), DELETE_BATCH_SIZE):
+            chunk = li_file_id[k:k + DELETE_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for file_id in chunk:
+                batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+            # every deletion in the batch counts against the quota
+            drive_limiter.take(len(chunk))
+            try:
+                # own http object, the one shared by PyDrive is not thread-safe
+                batch.execute(http=drive.auth.Get_Http_Object())
+            except Exception as e:
+                for file_id in chunk:
+                    failed.setdefault(file_id, e)
+
+        li_file_id = [file_id for file_id in li_file_id if file_id in failed and is_retryable_error(failed[file_id])]
+        if not li_file_id or attempt == QUOTA_RETRIES - 1:
+            break
+        wait = min(64, 2 ** attempt) * random.uniform(0.5, 1)
+        drive_limiter.add_backoff(wait)
+        time.sleep(wait)
+    return failed
+
+# Number of threads deleting/uploading shipper's files at the same time
+DRIVE_WORKERS = 4
 
 # HCO EXPORT TOOL
 # ==================================================================
+REDASH_URL = 'https://redash-vn.ninjavan.co'
+# Format of datetime columns returned by Redash
+REDASH_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Text columns with few distinct values, decoded as category
+REDASH_CATEGORY_COLUMNS = ['Tên đối tác', 'Lý do']
+# Seconds to wait for (connecting, reading response) from Redash
+REDASH_TIMEOUT = (10, 120)
+# Number of tracking ids sent in one query
+REDASH_CHUNK_SIZE = 1000
+# Max number of Redash requests running at the same time (1 = sequential)
+REDASH_MAX_IN_FLIGHT = 8
+# Job status is checked again after REDASH_POLL_MIN seconds, doubled after
+# each check (with jitter) up to REDASH_POLL_MAX seconds
+REDASH_POLL_MIN = 0.5
+REDASH_POLL_MAX = 10
+# Seconds a job can stay in queue + execution before it is given up
+REDASH_JOB_DEADLINE = 900
+# Local cache of Redash results, to skip queries already done when re-running tool
+REDASH_CACHE_FILE = 'redash_cache.sqlite'
+REDASH_CACHE_TTL = 12 * 60 * 60
+REDASH_CACHE_MAX_SIZE = 500 * 1024 * 1024
 
 # Call to Redash API
+class RedashClient:
+    """
+    Redash API client which owns a pooled requests.Session:
+    connections are kept alive and reused by every request and every worker thread,
+    instead of opening a new TLS connection for each request
+
+    Input:
+    - api_key
+    - url: Redash server
+    - pool_size: max number of connections kept alive (= number of worker threads)
+    - timeout: (connect, read) seconds
+    """
+    def __init__(self, api_key, url=REDASH_URL, pool_size=REDASH_MAX_IN_FLIGHT, timeout=REDASH_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Key {api_key}',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, endpoint) -> requests.Response:
+        return self.session.get(f'{self.url}/api/{endpoint}', timeout=self.timeout)
+
+    def post(self, endpoint, data) -> requests.Response:
+        return self.session.post(f'{self.url}/api/{endpoint}', data=data, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
 @retry(wait=wait_fixed(10), stop=stop_after_attempt(7))
-def redash_refresh(query_id, api_key, params={}) -> str:
+def redash_refresh(query_id, client, params={}) -> str:
     """
     Send POST request to refresh Redash-vn query data
     Use @retry decorator to refresh 3 times; if still error, raise ConnectionError
 
     Input:
     - query_id
-    - api_key
+    - client: RedashClient
     - params
 
     Output: job_id of query
     """
-    # Define request's params
-    _url = f'https://redash-vn.ninjavan.co/api/queries/{query_id}/results'
-    _header = {'Authorization': f'Key {api_key}'}
     _body = f'{{"max_age": 0, "parameters": {json.dumps(params, ensure_ascii=False)}}}'
 
-    _r = requests.post(url=_url, headers=_header, data=_body.encode('utf-8'))
+    _r = client.post(f'queries/{query_id}/results', data=_body.encode('utf-8'))
 
     if not _r.ok:
         raise ConnectionError
     return _r.json()['job']['id']
-@retry(wait=wait_fixed(10), retry=retry_if_result(lambda x: x is None))
-def redash_job_status(job_id, api_key) -> str:
-    """
-    Send GET request to check job status
-    Use @retry decorator to refresh; there will be 4 possible results:
-    - 
-    - status 1, 2: return None, will activate retry condition
-    - status 3: return result_id
+def redash_check_job(job_id, client) -> tuple:
+    """
+    Send GET request to check job status once, there will be 3 possible results:
+    - status 1 (pending), 2 (started): return (status, None)
+    - status 3: return (3, result_id)
     - status 4, 5: raise ConnectionError
 
     Input:
     - job_id
-    - api_key
+    - client: RedashClient
 
-    Output: result_id of query
+    Output: (job status, result_id of query)
     """
-    _url = f'https://redash-vn.ninjavan.co/api/jobs/{job_id}'
-    _header = {'Authorization': f'Key {api_key}'}
-
-    _r = requests.get(url=_url, headers=_header)
+    _r = client.get(f'jobs/{job_id}')
     job_status = _r.json()['job']['status']
 
     if job_status == 3:
-        return _r.json()['job']['query_result_id']
+        return job_status, _r.json()['job']['query_result_id']
     elif (job_status == 1) or (job_status == 2):
-        return None
+        return job_status, None
     else:
         raise ConnectionError
-def redash_result(result_id, api_key) -> pd.DataFrame:
+def redash_poll_jobs(jobs, client, pool=None, deadline=REDASH_JOB_DEADLINE):
+    """
+    Check status of many jobs with one poller, yield each job as soon as it is finished
+    Each job is checked again after an exponential backoff with jitter
+    (REDASH_POLL_MIN -> REDASH_POLL_MAX seconds); a job which is not finished
+    after deadline seconds is given up with TimeoutError
+
+    Input:
+    - jobs: dict of job_id: time the refresh request was sent
+    - client: RedashClient
+    - pool: (optional) ThreadPoolExecutor to check due jobs at the same time
+    - deadline
+
+    Output: generator of (job_id, result_id or exception, latency)
+    - latency: dict of queue time, execution time (seconds) and number of checks
+    """
+    pending = {job_id: {'sent': sent, 'started': None, 'polls': 0,
+                        'next': sent + REDASH_POLL_MIN * random.uniform(0.5, 1)}
+               for job_id, sent in jobs.items()}
+
+    def latency(job, finished):
+        started = job['started'] or finished
+        return {'queue': started - job['sent'], 'execution': finished - started, 'polls': job['polls']}
+
+    while pending:
+        now = time.time()
+        li_due = [job_id for job_id, job in pending.items() if job['next'] <= now]
+        if not li_due:
+            time.sleep(min(job['next'] for job in pending.values()) - now)
+            continue
+
+        _map = pool.map if pool is not None else map
+        li_status = _map(lambda job_id: _try(redash_check_job, job_id, client), li_due)
+        for job_id, status in zip(li_due, li_status):
+            job = pending[job_id]
+            job['polls'] += 1
+            now = time.time()
+            if isinstance(status, Exception):
+                del pending[job_id]
+                yield job_id, status, latency(job, now)
+                continue
+
+            job_status, result_id = status
+            if job_status != 1 and job['started'] is None:
+                job['started'] = now
+            if job_status == 3:
+                del pending[job_id]
+                yield job_id, result_id, latency(job, now)
+            elif now - job['sent'] > deadline:
+                del pending[job_id]
+                yield job_id, TimeoutError(f'Job {job_id} is not finished after {deadline}s'), latency(job, now)
+            else:
+                delay = min(REDASH_POLL_MAX, REDASH_POLL_MIN * 2 ** job['polls'])
+                job['next'] = now + delay * random.uniform(0.5, 1)
+def redash_job_status(job_id, client) -> str:
+    """
+    Check job status until the job is finished, using redash_poll_jobs
+    Raise ConnectionError if job is failed, TimeoutError if job is over deadline
+
+    Input:
+    - job_id
+    - client: RedashClient
+
+    Output: result_id of query
+    """
+    for _, result_id, _ in redash_poll_jobs({job_id: time.time()}, client):
+        if isinstance(result_id, Exception):
+            raise result_id
+        return result_id
+def redash_result(result_id, client) -> pd.DataFrame:
     """
     Send GET request to get query result
 
     Input:
     - result_id
-    - api_key
+    - client: RedashClient
 
     Output: dataframe of query result
     """
-    _url = f'https://redash-vn.ninjavan.co/api/query_results/{result_id}'
-    _header = {'Authorization': f'Key {api_key}'}
-
-    _r = requests.get(url=_url, headers=_header)
+    _r = client.get(f'query_results/{result_id}')
     if _r.ok:
-        return pd.DataFrame(_r.json()['query_result']['data']['rows'])
+        return redash_decode(fast_json.loads(_r.content))
     else:
         raise ConnectionError
+def redash_decode(payload) -> pd.DataFrame:
+    """
+    Build dataframe of query result column by column, using types in 'columns' of the payload
+    - integer: int64 (float64 if column has null value, as pandas reads it from json)
+    - float: float64
+    - datetime, date: datetime64
+    - REDASH_CATEGORY_COLUMNS: category
+    - others: object
+
+    Input: payload of query_results API (parsed json)
+
+    Output: dataframe of query result
+    """
+    data = payload['query_result']['data']
+    rows = data['rows']
+
+    columns = {}
+    for column in data['columns']:
+        name = column['name']
+        values = [row.get(name) for row in rows]
+        if column['type'] == 'integer':
+            # nullable Int64 is not used: fillna('-') and gspread cannot handle its <NA>
+            columns[name] = np.array(values, dtype='float64' if None in values else 'int64')
+        elif column['type'] == 'float':
+            columns[name] = np.array(values, dtype='float64')
+        elif column['type'] in ('datetime', 'date'):
+            try:
+                columns[name] = pd.to_datetime(values, format=REDASH_DATETIME_FORMAT).values
+            except ValueError:
+                columns[name] = pd.to_datetime(values).values
+        elif name in REDASH_CATEGORY_COLUMNS:
+            columns[name] = pd.Categorical(values)
+        else:
+            columns[name] = np.array(values, dtype=object)
+    return pd.DataFrame(columns, index=pd.RangeIndex(len(rows)))
+def concat_redash_results(li_rp) -> pd.DataFrame:
+    # Use the same categories in every chunk so category columns stay category after concat
+    for col in REDASH_CATEGORY_COLUMNS:
+        li_cat = [rp[col] for rp in li_rp if col in rp and rp[col].dtype == 'category']
+        if len(li_cat) == len(li_rp) and len(li_cat) > 1:
+            categories = union_categoricals(li_cat).categories
+            for rp in li_rp:
+                rp[col] = rp[col].cat.set_categories(categories)
+    return pd.concat(li_rp, ignore_index=True)
 @retry(wait=wait_fixed(5))
-def redash_query(query_id, api_key, params={}) -> pd.DataFrame:
+def redash_query(query_id, client, params={}) -> pd.DataFrame:
     """
     Combination of 3 funtions above
     Order of execution: refresh -> check job status -> get result
 
     Input:
     - query_id
-    - api_key
+    - client: RedashClient
     - params
 
     Output: dataframe of query result
     """
-    job_id = redash_refresh(query_id, api_key, params)
+    job_id = redash_refresh(query_id, client, params)
     print('Query request sent. Waiting for result...')
 
-    result_id = redash_job_status(job_id, api_key)
+    result_id = redash_job_status(job_id, client)
     print('Query completed!')
 
-    return redash_result(result_id, api_key)
-def running_redash(li_tracking_id, query_id, api_key):
-    li_arrays = np.array_split(li_tracking_id, (len(li_tracking_id)//1000)+1)
-    report = pd.DataFrame()
-    for k, df in enumerate(li_arrays):
-        print(k)
-        _query_params = {'tracking_id': f"""'{"', '".join(df.tracking_id)}'"""}
-        rp = redash_query(query_id, api_key, _query_params)
-        report = pd.concat([report, rp], ignore_index=True)
-        # report.to_csv('0901_fs.csv')
+    return redash_result(result_id, client)
+def redash_chunk_params(df) -> dict:
+    return {'tracking_id': f"""'{"', '".join(df.tracking_id)}'"""}
+def _try(func, *args):
+    # Return exception instead of raising it, used when mapping over a pool
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
+def running_redash_concurrent(li_arrays, query_id, client, max_in_flight, on_result=None) -> list:
+    """
+    Run all chunks at the same time with a pool of max_in_flight workers
+    Order of execution: refresh all chunks -> check status of all jobs together
+    -> get result of each job as soon as it is finished
+    Chunks which have error in any step are re-run by redash_query
+
+    Input:
+    - li_arrays: list of tracking id chunks
+    - query_id
+    - client: RedashClient
+    - max_in_flight
+    - on_result: (optional) function(k, dataframe) called when chunk k is done
+
+    Output: list of dataframe, in the same order as li_arrays
+    """
+    li_rp = [None] * len(li_arrays)
+    li_error = []
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        # Send refresh request of every chunk up front
+        refresh = {pool.submit(redash_refresh, query_id, client, redash_chunk_params(df)): k
+                   for k, df in enumerate(li_arrays)}
+        pending, sent = {}, {}
+        for future in as_completed(refresh):
+            try:
+                job_id = future.result()
+                pending[job_id], sent[job_id] = refresh[future], time.time()
+            except Exception as e:
+                print(e)
+                li_error.append(refresh[future])
+        print(f'{len(pending)} query requests sent. Waiting for result...')
+
+        # Check all pending jobs together, get result when job is finished
+        fetch = {}
+        total_queue, total_execution = 0, 0
+        for job_id, result_id, latency in redash_poll_jobs(sent, client, pool):
+            k = pending[job_id]
+            total_queue += latency['queue']
+            total_execution += latency['execution']
+            print(f"Query {k}: queue {latency['queue']:.1f}s, execution {latency['execution']:.1f}s, "
+                  f"{latency['polls']} checks")
+            if isinstance(result_id, Exception):
+                print(result_id)
+                li_error.append(k)
+            else:
+                fetch[pool.submit(redash_result, result_id, client)] = k
+
+        for future in as_completed(fetch):
+            try:
+                li_rp[fetch[future]] = future.result()
+                print(f'Query {fetch[future]} completed!')
+                if on_result is not None:
+                    on_result(fetch[future], li_rp[fetch[future]])
+            except Exception as e:
+                print(e)
+                li_error.append(fetch[future])
+    print(f'Total queue time: {total_queue:.1f}s, total execution time: {total_execution:.1f}s')
+
+    # Re-run error chunks one by one
+    for k in sorted(li_error):
+        print(f'Re-running query {k}')
+        li_rp[k] = redash_query(query_id, client, redash_chunk_params(li_arrays[k]))
+        if on_result is not None:
+            on_result(k, li_rp[k])
+    return li_rp
+def running_redash(li_tracking_id, query_id, client, max_in_flight=REDASH_MAX_IN_FLIGHT, cache=None):
+    li_arrays = np.array_split(li_tracking_id, (len(li_tracking_id)//REDASH_CHUNK_SIZE)+1)
+
+    # Load chunks already queried today from cache
+    hco_date = datetime.today().strftime("%d-%m-%Y")
+    li_key = [RedashCache.key(query_id, df.tracking_id, hco_date) for df in li_arrays]
+    li_rp = [cache.get(key) if cache is not None else None for key in li_key]
+    li_missing = [k for k, rp in enumerate(li_rp) if rp is None]
+    if cache is not None:
+        print(f'Loaded {len(li_arrays) - len(li_missing)}/{len(li_arrays)} queries from cache')
+
+    def on_result(i, rp):
+        li_rp[li_missing[i]] = rp
+        if cache is not None:
+            cache.put(li_key[li_missing[i]], rp)
+
+    li_query = [li_arrays[k] for k in li_missing]
+    if max_in_flight > 1 and li_query:
+        running_redash_concurrent(li_query, query_id, client, max_in_flight, on_result)
+    else:
+        for i, df in enumerate(li_query):
+            print(li_missing[i])
+            _query_params = redash_chunk_params(df)
+            on_result(i, redash_query(query_id, client, _query_params))
+            # report.to_csv('0901_fs.csv')
     print("Done extract data from redash")
-    return report
+    return concat_redash_results(li_rp)
+
+class RedashCache:
+    """
+    On-disk cache (SQLite) of Redash query results, so a rerun on the same day
+    does not send the same queries to Redash again
+
+    Key: query_id + hash of chunk's tracking ids + HCO date
+    - results older than ttl seconds are not used
+    - oldest results are removed when cache file is bigger than max_size bytes
+    - fresh=True: do not read from cache (results are still saved)
+    """
+    def __init__(self, file_name, ttl=REDASH_CACHE_TTL, max_size=REDASH_CACHE_MAX_SIZE, fresh=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.fresh = fresh
+        self.conn = sqlite3.connect(file_name)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS result (
+            key TEXT PRIMARY KEY, created_at REAL, size INTEGER, data BLOB)""")
+
+    @staticmethod
+    def key(query_id, li_tracking_id, hco_date) -> str:
+        digest = hashlib.sha256('\n'.join(li_tracking_id).encode('utf-8')).hexdigest()
+        return f'{query_id}:{digest}:{hco_date}'
+
+    def get(self, key):
+        if self.fresh:
+            return None
+        row = self.conn.execute(
+            'SELECT data FROM result WHERE key = ? AND created_at > ?', (key, time.time() - self.ttl)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def put(self, key, df):
+        data = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        self.conn.execute('INSERT OR REPLACE INTO result VALUES (?, ?, ?, ?)', (key, time.time(), len(data), data))
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        self.conn.execute('DELETE FROM result WHERE created_at <= ?', (time.time() - self.ttl,))
+        total_size = 0
+        for key, size in self.conn.execute(
+                'SELECT key, size FROM result ORDER BY created_at DESC').fetchall():
+            total_size += size
+            if total_size > self.max_size:
+                self.conn.execute('DELETE FROM result WHERE key = ?', (key,))
+
+    def close(self):
+        self.conn.close()
 
 # Using Openpyxl lib to create spreadsheet
 def set_col_width(worksheet, col, size):
     worksheet.column_dimensions[col].width = size
     return
-def set_style(worksheet, cell):
-    worksheet[cell].font = Font(bold=True)
-    worksheet[cell].alignment = Alignment(
+def set_style(worksheet, value):
+    # Header cell of write-only worksheet must be styled before it is written
+    cell = WriteOnlyCell(worksheet, value)
+    cell.font = Font(bold=True)
+    cell.alignment = Alignment(
         horizontal="center", vertical="center")
-    return
-def add_data_to_sheet(report_full, path):
+    return cell
+def add_data_to_sheet(report_full):
 
     # This function will add data by shipper to sheet
-    # and store the file in the path of local dir
+    # and return the name and the content (bytes) of the file, nothing is written to disk
+    # The workbook is write-only: rows are streamed to the file in a single pass,
+    # so column width and data validation are set before writing rows
 
-    workbook = Workbook()
-    worksheet = workbook.active
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
 
-    # import dataframe
-    for row in dataframe_to_rows(report_full, index=False):
-        worksheet.append(row)
+    # change column width
+    li_col = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K']
+    for i, j in zip(li_col, [20, 20, 30, 25, 40, 40, 40, 20, 14, 20, 20]):
+        set_col_width(worksheet, f'{i}', j)
 
     # data validation
     li_options = '"Giao lại, Hoàn hàng, Khách nhận rồi"'
     options = DataValidation(type="list", formula1=li_options)
     options.add('J2:J1048576')
-    worksheet.add_data_validation(options)
-
-    # change column width and font style
-    for i, j in zip(['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K'], [20, 20, 30, 25, 40, 40, 40, 20, 14, 20, 20]):
-        set_style(worksheet, f'{i}1')
-        set_col_width(worksheet, f'{i}', j)
+    worksheet.data_validations.append(options)
+
+    # import dataframe, with header in bold
+    rows = dataframe_to_rows(report_full, index=False)
+    header = next(rows)
+    worksheet.append([set_style(worksheet, value) if k < len(li_col) else value
+                      for k, value in enumerate(header)])
+    for row in rows:
+        worksheet.append(row)
 
-    # save WorkBook
+    # save WorkBook into memory
     workbook_name = list(report_full['Tên đối tác'])[0]
-    workbook.save(f'{path}/{workbook_name}.xlsx')
-    return workbook_name
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return workbook_name, buffer.getvalue()
+
+# Columns of shipper's file
+SHIPPER_FILE_COLUMNS = ["Mã", "Tên khách hàng", "Tên đối tác", "Số điện thoại", "Địa chỉ", "Hướng dẫn giao hàng",
+                        "Lý do", "Ngày tạo đơn", "Số lần giao", "Kết quả", "Ghi chú"]
+# Number of processes building shipper's files
+BUILD_WORKERS = os.cpu_count() or 1
+# Journal of shipper's files uploaded today, used to resume a stopped run
+EXPORT_JOURNAL_FILE = 'export_journal.jsonl'
+
+# Drive file property holding report_hash of the uploaded content
+# (the .xlsx bytes change on every build, so md5Checksum of the file cannot be compared)
+HASH_PROPERTY = 'hco_content_hash'
+
+def report_hash(report) -> str:
+    # Deterministic hash of the content written to a shipper's file
+    content = report[SHIPPER_FILE_COLUMNS]
+    # numbers are hashed as float64: 'Số lần giao' is float in rows of new shippers (outer merge
+    # in upload_type_2) and int in rows of the same shipper once its folder exists
+    content = content.astype({col: 'float64' for col in content.select_dtypes('number').columns})
+    digest = hashlib.md5('\x1f'.join(content.columns).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(content, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def hash_property(content_hash) -> list:
+    return [{'key': HASH_PROPERTY, 'value': content_hash, 'visibility': 'PUBLIC'}]
+
+def find_unchanged_file(drive_index, folder_id, content_hash):
+    # today's file of the folder which was uploaded with the same content, else None
+    cur_date = datetime.today().strftime("%d-%m-%Y")
+    for file in drive_index.get(folder_id):
+        properties = {p['key']: p.get('value') for p in file.get('properties', [])}
+        if file['title'][-15:-5] == cur_date and properties.get(HASH_PROPERTY) == content_hash:
+            return file
+    return None
+
+# Mime type of shipper's files uploaded from memory
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+class WorkbookStore:
+    """
+    In-memory store of the workbooks built in this run: {title: content of .xlsx file}
+    Shipper's files are uploaded from these buffers and each new workbook is added to the internal zip,
+    so the run does not write to or read from the local dir
+    """
+    def __init__(self, archive=None):
+        self.workbooks = {}
+        self.archive = archive
+        self.lock = threading.Lock()
+
+    def add(self, title, data):
+        with self.lock:
+            self.workbooks[title] = data
+        if self.archive is not None:
+            self.archive.add(title, data)
+
+    def open(self, title) -> BytesIO:
+        return BytesIO(self.workbooks[title])
+
+def build_shipper_file(report):
+    # create excel file (run in a worker process), report is already cleaned by sanitize_report
+    # "title" will be the name of report
+    return add_data_to_sheet(report)
+def build_shipper_files(report_dict, store):
+    """
+    Build excel file of every shipper in report_dict with a pool of BUILD_WORKERS processes
+
+    Input:
+    - report_dict: dictionary of reports by shipper
+    - store: WorkbookStore keeping the built files
+
+    Output: generator of (shipper, title of file or exception), in the order files are finished
+    """
+    with ProcessPoolExecutor(max_workers=BUILD_WORKERS) as pool:
+        futures = {pool.submit(build_shipper_file, report_dict[i][SHIPPER_FILE_COLUMNS].copy(deep=True)): i
+                   for i in report_dict}
+        for future in as_completed(futures):
+            try:
+                title, data = future.result()
+                store.add(title, data)
+                yield futures[future], title
+            except Exception as e:
+                yield futures[future], e
+def upload_pipeline(report_dict, store, upload, workers=DRIVE_WORKERS):
+    """
+    Build and upload shipper's files in a pipeline:
+    - excel files are built in worker processes (build_shipper_files)
+    - each built file is handed to a pool of `workers` threads running upload(shipper, title),
+      while the next files are still being built
+    Drive requests are rate limited by drive_call
+
+    Input:
+    - report_dict: dictionary of reports by shipper
+    - store: WorkbookStore keeping the built files
+    - upload: function(shipper, title) which uploads file of one shipper to Drive
+    - workers: number of Drive threads
+
+    Output: generator of (shipper, result of upload or exception), in the order uploads are finished
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for i, title in build_shipper_files(report_dict, store):
+            if isinstance(title, Exception):
+                yield i, title
+            else:
+                futures[pool.submit(upload, i, title)] = i
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+class ExportJournal:
+    """
+    Append-only journal (JSONL) of shipper's files uploaded today, so a rerun after the tool
+    stopped halfway skips building and uploading files which are already in Drive
+
+    One line per uploaded file: date, shipper (f_name), hash of the content (report_hash),
+    file_id, folder_id, and shipper_id/folder_name when the folder was created by the run
+    - lines of other days are dropped when the journal is opened
+    - fresh=True: start a new journal of today
+    """
+    def __init__(self, file_name, fresh=False):
+        self.date = datetime.today().strftime("%d-%m-%Y")
+        self.entries = {}
+        self.lock = threading.Lock()
+        if not fresh and os.path.exists(file_name):
+            with open(file_name, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a killed run may be cut
+                        continue
+                    if entry.get('date') == self.date:
+                        self.entries[entry['shipper']] = entry
+        self.file = open(file_name, 'w', encoding='utf-8')
+        for entry in self.entries.values():
+            self.write(entry)
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def done(self, shipper, content_hash, drive_index=None):
+        """
+        Entry of shipper if its file with the same content was uploaded today, else None
+        With drive_index, the file must also still be in its folder
+        """
+        entry = self.entries.get(shipper)
+        if entry is None or entry['hash'] != content_hash:
+            return None
+        if drive_index is not None and entry['file_id'] not in [file['id'] for file in drive_index.get(entry['folder_id'])]:
+            return None
+        return entry
+
+    def record(self, shipper, content_hash, file_id, folder_id, **kwargs):
+        entry = {'date': self.date, 'shipper': shipper, 'hash': content_hash,
+                 'file_id': file_id, 'folder_id': folder_id, **kwargs}
+        with self.lock:
+            self.entries[shipper] = entry
+            self.write(entry)
+
+    def new_folders(self):
+        # entries of shipper's folders created today
+        return [entry for entry in self.entries.values() if 'folder_name' in entry]
+
+    def close(self):
+        self.file.close()
 
 # Import shipper info
 def read_shipper_info(sheet):
-    temp = sheet.worksheet('shipper_info')
-    shipper_info_data = temp.get('A2:D')
+    temp = sheets_call(sheet.worksheet, 'shipper_info')
+    shipper_info_data = sheets_call(temp.get, 'A2:D')
 
     shipper_info = pd.DataFrame(columns=[
                                 'shipper_id', 'shipper_name', 'shipper_name_rut_gon', 'status'], data=shipper_info_data)
@@ -200,8 +933,8 @@ def read_shipper_info(sheet):
 
 # Import tracking id
 def read_tracking_id(sheet):
-    temp = sheet.worksheet('tracking_id')
-    tracking_id_data = temp.get('A2:A')
+    temp = sheets_call(sheet.worksheet, 'tracking_id')
+    tracking_id_data = sheets_call(temp.get, 'A2:A')
 
     li_tracking_id = pd.DataFrame(
         columns=['tracking_id'], data=tracking_id_data)
@@ -215,8 +948,7 @@ def import_shipper_folder(drive, co_tong_folder_id, sheet):
 
     # These SHIPPER FOLDERs will be edited by shipper
     print("Accessing folder drive... It might take a while..")
-    li_files = drive.ListFile(
-        {'q': f"'{co_tong_folder_id}' in parents and trashed=false"}).GetList()
+    li_files = get_li_files(drive, co_tong_folder_id)
 
     f_id = [i['id'] for i in li_files]
     f_name = [i['title'].strip() for i in li_files]
@@ -232,9 +964,9 @@ def import_shipper_folder(drive, co_tong_folder_id, sheet):
     shipper_folder = pd.DataFrame(columns=['folder_link', 'folder_name', 'created_date', 'owner_name'], data=zip(
         folder_link, f_name, created_date, owner))
 
-    _folder = sheet.worksheet('shipper_folder')
-    _folder.update([shipper_folder.columns.values.tolist()] +
-                   shipper_folder.values.tolist())
+    _folder = sheets_call(sheet.worksheet, 'shipper_folder')
+    sheets_call(_folder.update, [shipper_folder.columns.values.tolist()] +
+                shipper_folder.values.tolist())
     return co_tong_folder
 def create_internal_folder(drive, internal_folder_id):
     internal_date = datetime.today().strftime("%Y-%m-%d")
@@ -250,133 +982,226 @@ def create_internal_folder(drive, internal_folder_id):
         'parents': [{'id': internal_folder_id}],
         'mimeType': 'application/vnd.google-apps.folder'
     })
-    sub_folder.Upload()
+    drive_call(sub_folder.Upload)
     hco_internal_id = sub_folder['id']
     return hco_internal_id
 
+def sanitize_report(report) -> pd.DataFrame:
+    """
+    Remove characters which openpyxl cannot write from every text column of the report
+    Run once on the whole report before it is split by shipper
+    - each column is first checked as a whole, columns without illegal character are skipped
+    - only cells which have illegal characters are changed, other values are kept as is
+
+    Input: report
+
+    Output: cleaned report
+    """
+    for col in report.columns:
+        values = report[col]
+        if values.dtype == 'category':
+            if not has_illegal_characters(values.cat.categories):
+                continue
+            values = values.astype(object)
+        elif values.dtype != object or not has_illegal_characters(values.dropna()):
+            continue
+
+        illegal = values.str.contains(ILLEGAL_CHARACTERS_RE, na=False)
+        values = values.copy()
+        values[illegal] = values[illegal].str.replace(ILLEGAL_CHARACTERS_RE, '', regex=True)
+        report[col] = values
+    return report
+def has_illegal_characters(values) -> bool:
+    # Join the whole column to search it at once; fall back to per cell search if column has non-text values
+    try:
+        return ILLEGAL_CHARACTERS_RE.search('\n'.join(values)) is not None
+    except TypeError:
+        return bool(values.astype(str).str.contains(ILLEGAL_CHARACTERS_RE).any())
+
+def format_created_date(dates) -> pd.Series:
+    # 'Ngày tạo đơn' is datetime64 when decoded by redash_decode, text in older cached results
+    return pd.to_datetime(dates, format=REDASH_DATETIME_FORMAT).dt.strftime("%Y-%m-%d %H:%M:%S")
+def transliterate(names) -> pd.Series:
+    # unidecode each distinct name once, then map the result back to every row
+    # (object dtype, so an empty column can still be joined with strings)
+    return names.map({name: unidecode.unidecode(name) for name in names.unique()}).astype(object)
+
 # Merge report with shipper info and drive info
 def merge_report(report, shipper_info, co_tong_folder):
     # Merge report with shipper
-    report['shipper_id'] = [str(i.shipper_id) for i in report.itertuples()]
+    report['shipper_id'] = report['shipper_id'].astype(str)
     temp = report.merge(shipper_info, how='inner', on='shipper_id')
     temp.drop_duplicates(inplace=True)
 
     # Merge report with drive info
-    temp['f_name'] = [
-        "CO " + unidecode.unidecode(i.shipper_name_rut_gon.strip()).upper() for i in temp.itertuples()]
+    temp['f_name'] = "CO " + transliterate(temp['shipper_name_rut_gon'].str.strip()).str.upper()
     # temp = temp.astype({'f_name': 'object'})
     final = temp.merge(co_tong_folder, how='inner', on='f_name')
 
     # Format column
-    final['Ngày tạo đơn'] = [datetime.strptime(i, "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d %H:%M:%S") for i in list(final['Ngày tạo đơn'])]
+    final['Ngày tạo đơn'] = format_created_date(final['Ngày tạo đơn'])
     cur_date = datetime.today().strftime("%d-%m-%Y")
 
     # ***************** These codes below will impact on FILENAME *************************
 
-    final['Tên đối tác'] = ["CO " + unidecode.unidecode(i.shipper_name_rut_gon.strip()) 
-                            + " " + cur_date for i in final.itertuples()]
+    final['Tên đối tác'] = "CO " + transliterate(final['shipper_name_rut_gon'].str.strip()) + " " + cur_date
     final.rename(columns={'Instruction': 'Hướng dẫn giao hàng'}, inplace=True)
     final['Kết quả'], final['Ghi chú'] = '', ''
     print("Done - tracking id had matched shipper info and drive info")
     return temp, final
+class ReportPartition(Mapping):
+    """
+    Dictionary of reports by value of a column (e.g. f_name), built with one groupby
+    instead of scanning the whole report for every value
+    Report of each value is only sliced when it is first used, then kept
+    """
+    def __init__(self, report, column):
+        self.report = report
+        self.indices = report.groupby(column, sort=False).indices
+        self.parts = {}
+
+    def __getitem__(self, value):
+        if value not in self.parts:
+            self.parts[value] = self.report.iloc[self.indices[value]]
+        return self.parts[value]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
 def split_report(final):
     # Split report into reports by shipper
-    report_dict = {i: final[final['f_name'] == i]
-                   for i in set(list(final['f_name']))}
+    report_dict = ReportPartition(final, 'f_name')
     print("Done - splited report into dictionary of reports by shipper")
     return report_dict
 
 # PROCESS FILES IN DRIVE
-def del_file_drive(drive, folder_id):
+def del_file_drive(drive, folder_id, drive_index):
     # delete old file in drive to prevent duplicated file
+    # files of the folder are looked up in drive_index instead of listing the folder
 
     cur_date = datetime.today().strftime("%d-%m-%Y")
 
     try:
-        existed_files = drive.ListFile(
-            {'q': f"'{folder_id}' in parents and trashed=false"}).GetList()
+        existed_files = drive_index.get(folder_id)
         del_files = [file for file in existed_files if (file['title'][-15:-5] == cur_date)]
 
+        failed = batch_delete_files(drive, [file['id'] for file in del_files])
         for file in del_files:
-            del_file = drive.CreateFile({'id': file['id']})
-            del_file.Delete()
-            print(f'Deleted "{file["title"]}"')
+            if file['id'] in failed:
+                print(failed[file['id']])
+                print(f'Error when deleting "{file["title"]}"')
+            else:
+                drive_index.remove(folder_id, file['id'])
+                print(f'Deleted "{file["title"]}"')
     except Exception as e:
         print(e)
         print("Error when deleting file")
 def del_file_zip_drive(drive, li_del_files):
     # delete old file in drive to prevent duplicated file
     try:
+        failed = batch_delete_files(drive, [file['id'] for file in li_del_files])
         for file in li_del_files:
-            del_file = drive.CreateFile({'id': file['id']})
-            del_file.Delete()
-            print(f'Deleted "{file["title"]}"')
+            if file['id'] in failed:
+                print(failed[file['id']])
+                print(f'Error when deleting "{file["title"]}"')
+            else:
+                print(f'Deleted "{file["title"]}"')
     except Exception as e:
         print(e)
         print("Error when deleting file")
-def upload_file_drive(drive, dir, folder_id, title, done_export, report_dict, index, num_exported_folder):
-    try:
-        file_name = os.path.join(dir, f'{title}.xlsx')
-        shipper_report = drive.CreateFile({
-            'parents': [{'id': folder_id}],
-            'title': f'{title}.xlsx'
-        })
-        shipper_report.SetContentFile(file_name)
-        shipper_report.Upload()
+def upload_file_drive(drive, store, folder_id, title, done_export, report_dict, index, num_exported_folder, drive_index, journal):
+    # upload file of one shipper, raise if it fails so the caller can put the shipper in cant_export/error_export
+    content_hash = report_hash(report_dict[index])
+    shipper_report = drive.CreateFile({
+        'parents': [{'id': folder_id}],
+        'title': f'{title}.xlsx',
+        'mimeType': XLSX_MIME_TYPE,
+        'properties': hash_property(content_hash)
+    })
+    shipper_report.content = store.open(title)
+    drive_call(shipper_report.Upload)
+    drive_index.add(folder_id, shipper_report)
+    journal.record(index, content_hash, shipper_report['id'], folder_id)
 
-        done_export = pd.concat([done_export, report_dict[index]])
-        num_exported_folder += 1
-    except Exception as e:
-        print(e)
+    done_export.append(report_dict[index])
+    num_exported_folder += 1
     return done_export, num_exported_folder
 
 # - TYPE 1: file that contains shipper info and folder info
 # - TYPE 2: file that ONLY contains shipper info - need to create
 # new folder for the shipper in CO SHIPPER TONG
-def upload_type_1(drive, report_full, report_dict, done_export, cant_export, num_exported_folder, path, dir):
+def upload_type_1(drive, report_full, report_dict, done_export, cant_export, num_exported_folder, store, drive_index, journal):
     print('UPLOADING FILE TYPE 1 ...')
 
-    k = 1
+    # list files of all shipper's folders in a few bulk queries
+    drive_index.load(report_full['f_id'].dropna().unique())
+
     flag_upload = 0
     flag_cant_export = 0
 
-    for i in list(set(report_full['f_name'])):
-        temp = report_dict[i][["Mã", "Tên khách hàng", "Tên đối tác", "Số điện thoại",
-                               "Địa chỉ", "Hướng dẫn giao hàng", "Lý do", "Ngày tạo đơn",
-                               "Số lần giao", "Kết quả", "Ghi chú"]].copy(deep=True)
-        temp = temp.applymap(lambda x: ILLEGAL_CHARACTERS_RE.sub(r'', x) if isinstance(x, str) else x)
+    # skip shippers whose file of today is already in Drive with the same content:
+    # uploaded by a stopped run (journal) or by an earlier run (hash in file's properties)
+    flag_resume = 0
+    flag_unchanged = 0
+    li_skipped = set()
+    for i in report_dict:
+        folder_id = list(report_dict[i]['f_id'])[0]
+        content_hash = report_hash(report_dict[i])
         try:
-            # format report, create excel file
-
-            # "title" will be the name of report
-
-            title = add_data_to_sheet(temp, path)
-
-            folder_id = list(report_dict[i]['f_id'])[0]
-            # print(folder_id)
-
-            # delete file & upload file
-            
-            del_file_drive(drive, folder_id)
-            done_export, num_exported_folder = upload_file_drive(
-                drive, dir, folder_id, title, done_export, report_dict, i, num_exported_folder)
-
-            flag_upload += 1
+            if journal.done(i, content_hash, drive_index) is not None:
+                flag_resume += 1
+            else:
+                file = find_unchanged_file(drive_index, folder_id, content_hash)
+                if file is None:
+                    continue
+                journal.record(i, content_hash, file['id'], folder_id)
+                flag_unchanged += 1
         except Exception as e:
+            # folder could not be listed: upload the file as usual
             print(e)
-            cant_export = pd.concat([cant_export, report_dict[i]])
-            flag_cant_export += 1
-
-        k += 1
-        if k % 3 == 0:
-            time.sleep(1)
+            continue
+        li_skipped.add(i)
+        done_export.append(report_dict[i])
+        num_exported_folder += 1
+    if flag_resume > 0:
+        print(f'No. file uploaded by previous run: {flag_resume}')
+    if flag_unchanged > 0:
+        print(f'No. unchanged file (not uploaded again): {flag_unchanged}')
+
+    def upload(i, title):
+        # file of a skipped shipper is only built for the internal zip
+        if i in li_skipped:
+            return None
+
+        folder_id = list(report_dict[i]['f_id'])[0]
+        # print(folder_id)
+
+        # delete file & upload file
+        del_file_drive(drive, folder_id, drive_index)
+        _, num_exported = upload_file_drive(
+            drive, store, folder_id, title, done_export, report_dict, i, 0, drive_index, journal)
+        return num_exported
+
+    # excel files are built in worker processes, then uploaded by DRIVE_WORKERS threads
+    for i, result in upload_pipeline(report_dict, store, upload):
+        if isinstance(result, Exception):
+            print(result)
+            if i not in li_skipped:
+                cant_export.append(report_dict[i])
+                flag_cant_export += 1
+        elif result is not None:
+            num_exported_folder += result
+            flag_upload += 1
     print(f'No. uploaded file: {flag_upload}')
     print(f'No. cant export file: {flag_cant_export}')
     return done_export, cant_export, num_exported_folder
     # if k % 100 == 0:
     #     gc, drive = connect_drive(bi_key)
     #     print("Drive reconnected")
-def upload_type_2(drive, report_shipper, shipper_folder, shipper_folder_id, path, dir, done_export, cant_export):
+def upload_type_2(drive, report_shipper, shipper_folder, shipper_folder_id, store, done_export, cant_export, journal):
     print('UPLOADING FILE TYPE 2 ...')
 
     flag_create = 0
@@ -387,102 +1212,103 @@ def upload_type_2(drive, report_shipper, shipper_folder, shipper_folder_id, path
 
     # format columns
     cur_date = datetime.today().strftime("%d-%m-%Y")
-    folder_drive_shortage['Ngày tạo đơn'] = [datetime.strptime(
-        i, "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d %H:%M:%S") for i in list(folder_drive_shortage['Ngày tạo đơn'])]
-    folder_drive_shortage['Tên đối tác'] = ["CO " + unidecode.unidecode(
-        i.shipper_name_rut_gon) + " " + cur_date for i in folder_drive_shortage.itertuples()]
+    folder_drive_shortage['Ngày tạo đơn'] = format_created_date(folder_drive_shortage['Ngày tạo đơn'])
+    folder_drive_shortage['Tên đối tác'] = "CO " + transliterate(
+        folder_drive_shortage['shipper_name_rut_gon']) + " " + cur_date
     folder_drive_shortage.rename(
         columns={'Instruction': 'Hướng dẫn giao hàng'}, inplace=True)
     folder_drive_shortage["Kết quả"], folder_drive_shortage["Ghi chú"] = '', ''
 
     # Split file
-    report_dict_no_folder = {i: folder_drive_shortage[folder_drive_shortage['f_name'] == i] for i in set(
-        folder_drive_shortage['f_name'])}
+    report_dict_no_folder = ReportPartition(folder_drive_shortage, 'f_name')
 
     li_new_shipper_id, li_new_folder_name, li_new_folder_link = [], [], []
 
-    k = 1
-    for i in list(set(folder_drive_shortage['f_name'])):
-        final_report = report_dict_no_folder[i][["Mã", "Tên khách hàng", "Tên đối tác", "Số điện thoại", "Địa chỉ",
-                                                 "Hướng dẫn giao hàng", "Lý do", "Ngày tạo đơn", "Số lần giao", "Kết quả", "Ghi chú"]].copy(deep=True)
-        final_report = final_report.applymap(
-            lambda x: ILLEGAL_CHARACTERS_RE.sub(r'', x) if isinstance(x, str) else x)
-        try:
-            # format report, create excel file
-            title = add_data_to_sheet(final_report, path)
-
-            # create and upload new shipper folder to drive
-            new_folder_name = "CO " + \
-                unidecode.unidecode(list(report_dict_no_folder[i]['shipper_name_rut_gon'])[
-                                    0]).upper().strip()
-            new_folder = drive.CreateFile({
-                'title': new_folder_name,
-                'parents': [{'id': shipper_folder_id}],
-                'mimeType': 'application/vnd.google-apps.folder'})
-            new_folder.Upload()
-            folder_id = new_folder['id']
-
-            # upload shipper report to drive shipper folder
-            file_name = os.path.join(dir, f'{title}.xlsx')
-            shipper_report = drive.CreateFile({
-                'parents': [{'id': folder_id}],
-                'title': f'{title}.xlsx'
-            })
-            shipper_report.SetContentFile(file_name)
-            shipper_report.Upload()
-            flag_create += 1
-
-            # add folder id to output sheet to get shipper response
-            report_dict_no_folder[i]['f_id'] = folder_id
-
-            li_new_shipper_id.append(
-                list(report_dict_no_folder[i]['shipper_id'])[0])
-            li_new_folder_name.append(new_folder_name)
-            li_new_folder_link.append(
-                f"https://drive.google.com/drive/u/0/folders/{folder_id}")
-            done_export = pd.concat([done_export, report_dict_no_folder[i]])
-            k += 1
-        except Exception as e:
-            print(e)
-            cant_export = pd.concat([cant_export, report_dict_no_folder[i]])
+    def upload(i, title):
+        # create and upload new shipper folder to drive
+        new_folder_name = "CO " + \
+            unidecode.unidecode(list(report_dict_no_folder[i]['shipper_name_rut_gon'])[
+                                0]).upper().strip()
+        new_folder = drive.CreateFile({
+            'title': new_folder_name,
+            'parents': [{'id': shipper_folder_id}],
+            'mimeType': 'application/vnd.google-apps.folder'})
+        drive_call(new_folder.Upload)
+        folder_id = new_folder['id']
+
+        # upload shipper report to drive shipper folder
+        content_hash = report_hash(report_dict_no_folder[i])
+        shipper_report = drive.CreateFile({
+            'parents': [{'id': folder_id}],
+            'title': f'{title}.xlsx',
+            'mimeType': XLSX_MIME_TYPE,
+            'properties': hash_property(content_hash)
+        })
+        shipper_report.content = store.open(title)
+        drive_call(shipper_report.Upload)
+        journal.record(i, content_hash, shipper_report['id'], folder_id,
+                       shipper_id=list(report_dict_no_folder[i]['shipper_id'])[0], folder_name=new_folder_name)
+        return new_folder_name, folder_id
+
+    # excel files are built in worker processes, then uploaded by DRIVE_WORKERS threads
+    for i, result in upload_pipeline(report_dict_no_folder, store, upload):
+        if isinstance(result, Exception):
+            print(result)
+            cant_export.append(report_dict_no_folder[i])
             flag_cant_export += 1
-
-        if k % 20 == 0:
-            time.sleep(1)
-            #     gc, drive = connect_drive(bi_key)
-            #     print("Drive reconnected")
+            continue
+
+        new_folder_name, folder_id = result
+        flag_create += 1
+
+        # add folder id to output sheet to get shipper response
+        report_dict_no_folder[i]['f_id'] = folder_id
+
+        li_new_shipper_id.append(
+            list(report_dict_no_folder[i]['shipper_id'])[0])
+        li_new_folder_name.append(new_folder_name)
+        li_new_folder_link.append(
+            f"https://drive.google.com/drive/u/0/folders/{folder_id}")
+        done_export.append(report_dict_no_folder[i])
+
+    # folders created by a stopped run of today are still new shippers of today
+    for entry in journal.new_folders():
+        if entry['shipper_id'] not in li_new_shipper_id:
+            li_new_shipper_id.append(entry['shipper_id'])
+            li_new_folder_name.append(entry['folder_name'])
+            li_new_folder_link.append(
+                f"https://drive.google.com/drive/u/0/folders/{entry['folder_id']}")
     print(f'No. create folder: {flag_create}')
     print(f'No. cant export file: {flag_cant_export}')
     return li_new_shipper_id, li_new_folder_name, li_new_folder_link, done_export, cant_export
 
 # Re-upload file that cannot export
-def reup_cant_export_file(drive, cant_export, dir, done_export, report_dict, num_exported_folder, bi_key):
-    error_export = pd.DataFrame()
+def reup_cant_export_file(drive, cant_export, store, done_export, report_dict, num_exported_folder, bi_key, drive_index, journal):
+    error_export = FrameAccumulator()
     flag = True
-    if cant_export.shape[0] > 0:
+    if len(cant_export) > 0:
         print("Error data exists")
-        cant_export_dict = {
-            i: cant_export[cant_export['f_name'] == i] for i in set(cant_export['f_name'])}
+        cant_export = cant_export.concat()
+        cant_export_dict = ReportPartition(cant_export, 'f_name')
         # k = 1
-        for i in list(set(cant_export['f_name'])):
-            final_report = cant_export_dict[i][["Mã", "Tên khách hàng", "Tên đối tác", "Số điện thoại", "Địa chỉ", "Hướng dẫn giao hàng",
-                                                "Lý do", "Ngày tạo đơn", "Số lần giao", "Kết quả", "Ghi chú"]].copy(deep=True)
-            final_report = final_report.applymap(
-                lambda x: ILLEGAL_CHARACTERS_RE.sub(r'', x) if isinstance(x, str) else x)
-
+        for i, title in build_shipper_files(cant_export_dict, store):
             try:
-                # format report, save as excel file, shipper_folder_id
-                title = add_data_to_sheet(final_report)
+                if isinstance(title, Exception):
+                    raise title
                 folder_id = list(cant_export_dict[i]['f_id'])[0]
                 print(folder_id)
+                # new shipper (type 2) whose folder could not be created has no folder to upload to
+                if pd.isna(folder_id):
+                    raise ValueError(f'No Drive folder for "{i}"')
 
                 # delete file & upload file
-                del_file_drive(drive, folder_id)
-                upload_file_drive(drive, dir, folder_id, title,
-                                  done_export, report_dict, i, num_exported_folder)
+                # rows of type 2 shippers are not in report_dict, they are taken from cant_export
+                del_file_drive(drive, folder_id, drive_index)
+                upload_file_drive(drive, store, folder_id, title,
+                                  done_export, cant_export_dict, i, num_exported_folder, drive_index, journal)
             except Exception as e:
                 print(e)
-                error_export = pd.concat([error_export, cant_export_dict[i]])
+                error_export.append(cant_export_dict[i])
                 flag = False
             # k += 1
             # if k % 100 == 0:
@@ -491,56 +1317,260 @@ def reup_cant_export_file(drive, cant_export, dir, done_export, report_dict, num
     else:
         print("Not any error data exist")
         pass
-    return error_export, flag
+    return error_export.concat(), flag
 
 # Zip file and upload to Internal folder
-def find_duplicated_zipfile(drive, find_date, parents_id):
+def find_duplicated_zipfile(drive_index, find_date, parents_id):
     li_files = []
     folder_id = ''
     cur_date = datetime.today().strftime("%d-%m-%Y")
-    li_folders = get_li_files(drive, parents_id)
+    li_folders = drive_index.get(parents_id)
     for folder in li_folders:
         if folder['title'][-10:] == find_date:
-            temp = get_li_files(drive, folder['id'])
+            temp = drive_index.get(folder['id'])
             li_files = [file for file in temp if file['title'][:-4] == cur_date]
             folder_id = folder['id']
     return li_files, folder_id
-def upload_zip_to_internal_folder(path, dir, drive, internal_folder_id):
-    cur_date = datetime.today().strftime("%d-%m-%Y")
+# Compression of the internal zip: zipfile.ZIP_STORED (store only) or zipfile.ZIP_DEFLATED
+# .xlsx files are already compressed, storing them gives about the same zip size without the CPU time
+ZIP_COMPRESSION = zipfile.ZIP_STORED
+# Level of ZIP_DEFLATED, from 1 (fastest) to 9 (smallest)
+ZIP_COMPRESSLEVEL = 6
+# Size of each part sent by the resumable upload of the zip, must be a multiple of 256 KB
+ZIP_CHUNK_SIZE = 20 * 256 * 1024
+
+class ZipUploadStream(MediaUpload):
+    """
+    Content of the internal zip, written by ZipFile and read by a resumable upload at the same time
+    - write(): ZipFile appends the bytes of each added workbook (stream is not seekable,
+      so ZipFile writes the sizes after each file instead of seeking back)
+    - getbytes(): upload reads the next part, bytes before it are already uploaded and dropped
+    Size of the upload is unknown until close()
+    """
+    def __init__(self, chunksize=ZIP_CHUNK_SIZE):
+        self.buffer = bytearray()
+        # position of buffer[0] in the zip
+        self.offset = 0
+        self.closed = False
+        self._chunksize = chunksize
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        with self.cond:
+            self.buffer += data
+            self.cond.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
 
-    find_date = datetime.today().strftime("%Y-%m-%d")
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
 
-    li_duplicated_files, upload_folder_id = find_duplicated_zipfile(drive, find_date, internal_folder_id)
-    
-    if len(li_duplicated_files) > 0:
-        del_file_zip_drive(drive, li_duplicated_files)
+    def wait(self, begin):
+        # wait until more than one part is written after begin, or the zip is finished,
+        # so the last part is always sent together with the total size
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.offset + len(self.buffer) > begin + self._chunksize)
 
+    def getbytes(self, begin, length):
+        with self.cond:
+            del self.buffer[:begin - self.offset]
+            self.offset = begin
+            return bytes(self.buffer[:length])
 
-    with zipfile.ZipFile(f"{path}/{cur_date}.zip", mode="w") as archive:
-        for file_path in dir.rglob("*.xlsx"):
-            archive.write(file_path, arcname=file_path.relative_to(dir))
+    def size(self):
+        with self.cond:
+            return self.offset + len(self.buffer) if self.closed else None
 
-    for zip_file in dir.rglob(f"*.zip"):
-        file_name = os.path.join(dir, zip_file)
-        if upload_folder_id == '':
-            upload_folder_id = create_internal_folder(drive, internal_folder_id)
-        
-        internal_report = drive.CreateFile({
-            'parents': [{'id': upload_folder_id}],
-            'title': f'{cur_date}'
-        })
-        internal_report.SetContentFile(file_name)
-        internal_report.Upload()
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return 'application/zip'
 
-# Delete file from directory
-def del_file_in_directory(dir, file_type):
-    for file_path in dir.rglob(file_type):
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+class InternalArchive:
+    """
+    Zip of the workbooks of this run in the internal folder, built and uploaded while shipper's files are exported
+    - add(): workbook is written to a streaming ZipFile as soon as it is built
+    - parts of the zip are uploaded by a resumable upload in a background thread as they are written
+    - close(): finish the zip and wait for the last part of the upload,
+      then delete the zips it replaces, so a failed run leaves the old zip in Drive
+    """
+    def __init__(self, drive, folder_id, title, li_replaced_files=(), compression=ZIP_COMPRESSION, compresslevel=ZIP_COMPRESSLEVEL):
+        self.drive = drive
+        self.li_replaced_files = list(li_replaced_files)
+        self.stream = ZipUploadStream()
+        self.zip = zipfile.ZipFile(self.stream, mode='w', compression=compression, compresslevel=compresslevel)
+        self.names = set()
+        self.lock = threading.Lock()
+        self.error = None
+        self.thread = threading.Thread(target=self.upload, args=(folder_id, title), daemon=True)
+        self.thread.start()
+
+    def add(self, title, data):
+        name = f'{title}.xlsx'
+        with self.lock:
+            # file rebuilt by reup_cant_export_file is already in the zip
+            if name in self.names:
+                return
+            self.names.add(name)
+            self.zip.writestr(name, data)
+
+    def upload(self, folder_id, title):
         try:
-            os.remove(file_path)
+            # files.insert with a streamed body is not wrapped by PyDrive, authorize it before using its service
+            if self.drive.auth.service is None:
+                self.drive.auth.Authorize()
+            request = self.drive.auth.service.files().insert(body={
+                'parents': [{'id': folder_id}],
+                'title': title,
+                'mimeType': 'application/zip'
+            }, media_body=self.stream)
+            http = self.drive.auth.Get_Http_Object()
+            response = None
+            while response is None:
+                self.stream.wait(request.resumable_progress)
+                drive_limiter.take()
+                # a part failed by rate limit or server error is resent by googleapiclient
+                _, response = request.next_chunk(http=http, num_retries=QUOTA_RETRIES)
         except Exception as e:
-            print(e)
+            self.error = e
+
+    def close(self):
+        with self.lock:
+            self.zip.close()
+        self.stream.close()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if len(self.li_replaced_files) > 0:
+            del_file_zip_drive(self.drive, self.li_replaced_files)
+
+def open_internal_archive(drive, internal_folder_id, drive_index):
+    """
+    Start uploading a new zip of today in the internal folder
+    The zip of today uploaded by an earlier run is deleted by close() once the new one is uploaded
+
+    Input:
+    - internal_folder_id: id of the internal folder
+    - drive_index: DriveIndex of this run
+
+    Output: InternalArchive, workbooks are added to it while they are built
+    """
+    cur_date = datetime.today().strftime("%d-%m-%Y")
+
+    find_date = datetime.today().strftime("%Y-%m-%d")
+
+    li_duplicated_files, upload_folder_id = find_duplicated_zipfile(drive_index, find_date, internal_folder_id)
+
+    if upload_folder_id == '':
+        upload_folder_id = create_internal_folder(drive, internal_folder_id)
+
+    # title matches the zip of today looked up by find_duplicated_zipfile on the next run
+    return InternalArchive(drive, upload_folder_id, f'{cur_date}.zip', li_duplicated_files)
 
 # OUTPUT
+# Max cells sent in one values.batchUpdate request (request body is limited by Sheets API)
+SHEETS_BATCH_CELLS = 200000
+
+class SheetWriter:
+    """
+    Collect writes to worksheets of one spreadsheet, then send them in as few requests as possible
+    - metadata of all worksheets is fetched once
+    - clear(): sheets are cleared together by one values.batchClear
+    - update(): ranges are written together by values.batchUpdate, at most SHEETS_BATCH_CELLS cells per request
+    - worksheets too small for the written rows/columns are extended by one batchUpdate before writing
+    """
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.worksheets = {ws.title: ws for ws in sheets_call(spreadsheet.worksheets)}
+        self.clears = []
+        self.writes = []
+
+    def get(self, li_range) -> list:
+        # values of many ranges in one request, in the order of li_range
+        response = sheets_call(self.spreadsheet.values_batch_get, li_range)
+        return [value_range.get('values', []) for value_range in response['valueRanges']]
+
+    def clear(self, title):
+        self.clears.append(title)
+
+    def update(self, title, rows, row=1, col=1):
+        # nothing to write for no rows or rows without cells (header of an empty frame)
+        if not rows or not any(rows):
+            return
+        self.writes.append((title, row, col, rows))
+
+    def flush(self):
+        self.resize()
+        if self.clears:
+            sheets_call(self.spreadsheet.values_batch_clear,
+                        body={'ranges': [gspread.utils.absolute_range_name(title) for title in self.clears]})
+
+        data, cells = [], 0
+        for title, row, col, rows in self.writes:
+            width = max(len(r) for r in rows)
+            if width == 0:
+                continue
+            step = max(1, SHEETS_BATCH_CELLS // width)
+            for k in range(0, len(rows), step):
+                chunk = rows[k:k + step]
+                if data and cells + len(chunk) * width > SHEETS_BATCH_CELLS:
+                    self.send(data)
+                    data, cells = [], 0
+                start = gspread.utils.rowcol_to_a1(row + k, col)
+                data.append({'range': gspread.utils.absolute_range_name(title, start), 'values': chunk})
+                cells += len(chunk) * width
+        if data:
+            self.send(data)
+        self.clears, self.writes = [], []
+
+    def send(self, data):
+        sheets_call(self.spreadsheet.values_batch_update,
+                    body={'valueInputOption': 'RAW', 'data': data})
+
+    def resize(self):
+        # rows/columns written past the grid of a worksheet are rejected, add them first
+        size = {}
+        for title, row, col, rows in self.writes:
+            if not rows or not any(rows):
+                continue
+            n_row, n_col = size.get(title, (0, 0))
+            size[title] = (max(n_row, row + len(rows) - 1), max(n_col, col + max(len(r) for r in rows) - 1))
+        requests = []
+        for title, (n_row, n_col) in size.items():
+            ws = self.worksheets[title]
+            for dimension, length in [('ROWS', n_row - ws.row_count), ('COLUMNS', n_col - ws.col_count)]:
+                if length > 0:
+                    requests.append({'appendDimension': {'sheetId': ws.id, 'dimension': dimension, 'length': length}})
+        if requests:
+            sheets_call(self.spreadsheet.batch_update, {'requests': requests})
+
+def sheet_rows(df) -> list:
+    """
+    Header and rows of a dataframe as values which can be sent to Sheets (json):
+    - datetime columns are written as text (REDASH_DATETIME_FORMAT)
+    - missing cells (NaN, NaT, None, also in category columns) are written as empty cells
+
+    Input: dataframe
+
+    Output: list of rows, header first
+    """
+    df = df.copy()
+    for col in df.select_dtypes('datetime').columns:
+        df[col] = df[col].dt.strftime(REDASH_DATETIME_FORMAT)
+    df = df.astype(object)
+    df = df.where(df.notna(), None)
+    return [df.columns.values.tolist()] + df.values.tolist()
 def output(output_sheet, li_new_shipper_id, li_new_shipper_name, li_new_shipper_folder_link, done_export, report, shipper_info, error_export):
     # New shipper
     new_shipper = pd.DataFrame(columns=['shipper_id', 'folder_name', 'folder_link'],
@@ -551,6 +1581,7 @@ def output(output_sheet, li_new_shipper_id, li_new_shipper_name, li_new_shipper_
                                'Tên khách hàng', 'shipper_id', 'Tên đối tác', 'Địa chỉ',
                                'Số điện thoại', 'shipper_name', 'shipper_name_rut_gon', 'status',
                                'f_name', 'f_id']].copy(deep=True)
+    done_export = done_export.astype({col: object for col in done_export.select_dtypes('category').columns})
     done_export.fillna('-', inplace=True)
 
     # No missing shipper info
@@ -568,45 +1599,45 @@ def output(output_sheet, li_new_shipper_id, li_new_shipper_name, li_new_shipper_
               }
 
     # Update result into Sheet "Output Check"
-
-    # Define worksheets
-    # sheet = output_sheet.worksheet("result")
-    # last_runtime = sheet.get("B2")[0][0][:10]
-
-    output1 = output_sheet.worksheet('done_export')
-    output2 = output_sheet.worksheet('no_shipper_info')
-    output3 = output_sheet.worksheet('new_shipper')
-    output4 = output_sheet.worksheet('result')
-    output5 = output_sheet.worksheet('error_export')
+    # All worksheets are read and written through one SheetWriter (few batch requests)
+    writer = SheetWriter(output_sheet)
+    # frames are written through sheet_rows: NaN of category/datetime columns cannot be sent as json
+    done_export_rows = sheet_rows(done_export)
 
     # Done export
-    result_date = output4.get("B2")[0][0][:10]
+    # key of a done_export row: tracking id + shipper's file name (which has the date)
+    col_key = [done_export.columns.get_loc(col) + 1 for col in ['Mã', 'Tên đối tác']]
+    range_key = [gspread.utils.absolute_range_name('done_export', f'{letter}:{letter}')
+                 for letter in [gspread.utils.rowcol_to_a1(1, col)[:-1] for col in col_key]]
+    result_b2, existed_ma, existed_name = writer.get(
+        [gspread.utils.absolute_range_name('result', 'B2')] + range_key)
+    result_date = result_b2[0][0][:10]
     is_cur_date_data = True if result_date == datetime.today().strftime("%d-%m-%Y") else False  #ternary operator
-    
+
     if is_cur_date_data:
-        output1.clear()
-        output1.update([done_export.columns.values.tolist()] +
-                   done_export.values.tolist())
+        writer.clear('done_export')
+        writer.update('done_export', done_export_rows)
     else:
-        # for row in done_export.values.tolist():
-        #     output1.append_row(row)
-        output1.append_rows(done_export.values.tolist())
+        # append only rows which are not in the sheet yet, after its last row
+        existed_rows = set(zip([r[0] if r else '' for r in existed_ma[1:]],
+                               [r[0] if r else '' for r in existed_name[1:]]))
+        new_rows = [row for row in done_export_rows[1:]
+                    if (str(row[col_key[0] - 1]), str(row[col_key[1] - 1])) not in existed_rows]
+        writer.update('done_export', new_rows, row=max(len(existed_ma), len(existed_name)) + 1)
 
-    output2.clear()
-    output2.update([shipper_info_shortage.columns.values.tolist()
-                    ] + shipper_info_shortage.values.tolist())
+    writer.clear('no_shipper_info')
+    writer.update('no_shipper_info', sheet_rows(shipper_info_shortage))
 
-    output3.clear()
-    output3.update([new_shipper.columns.values.tolist()] +
-                   new_shipper.values.tolist())
+    writer.clear('new_shipper')
+    writer.update('new_shipper', sheet_rows(new_shipper))
 
-    output4.update("B2", str(
-        f'{datetime.today().strftime("%d-%m-%Y")} {datetime.now().strftime("%H:%M:%S")}'))
-    output4.update("A5:D5", [list(result.values())])
+    writer.update('result', [[str(
+        f'{datetime.today().strftime("%d-%m-%Y")} {datetime.now().strftime("%H:%M:%S")}')]], row=2, col=2)
+    writer.update('result', [list(result.values())], row=5, col=1)
 
-    output5.clear()
-    output5.update([error_export.columns.values.tolist()] +
-                   error_export.values.tolist())
+    writer.clear('error_export')
+    writer.update('error_export', sheet_rows(error_export))
+    writer.flush()
 
 path = pathlib.Path().absolute()
 directory = pathlib.Path(path)
@@ -624,17 +1655,14 @@ bi_key = {
     "client_x509_cert_url": "https://www.googleapis.com/robot/v1/metadata/x509/vn-bi-6th%40vn-bi-337205.iam.gserviceaccount.com"
 }
 
-# Connect Drive
-gc, drive = connect_drive(bi_key,auth,drive,gspread)
-
-def main():
+def main(fresh=False):
     #sheet Output
     # output_sheet = gc.open_by_key("16Old5szbBUNVZ6lwRoY9O4sl_6FVHwXOO0a5jKg4Em4") #test
-    output_sheet = gc.open_by_key("1JvkWaECyz6FVdvm8kOkYJD1z7utS97UPs_Hp1KXfJ0c")
+    output_sheet = sheets_call(gc.open_by_key, "1JvkWaECyz6FVdvm8kOkYJD1z7utS97UPs_Hp1KXfJ0c")
 
     #sheet Input (shipper info + tracking_id)
     # input = gc.open_by_key('1nsIYsze2SWaDT6WxWkwCsXiK_E7RHfx-5dLpNaXtwbw') #test
-    input = gc.open_by_key('1NOPFnRDrVwZW9rZvpHNkFa_r5edMYNX_hc2O-SBeS8k')
+    input = sheets_call(gc.open_by_key, '1NOPFnRDrVwZW9rZvpHNkFa_r5edMYNX_hc2O-SBeS8k')
 
     #CO TONG FOLDER
     # shipper_folder_id = '1X12fJDQngElzhrWXvkCijasOlR8VJ0W3' #test
@@ -653,47 +1681,71 @@ def main():
     shipper_info = read_shipper_info(input)
     li_tracking_id = read_tracking_id(input)
     shipper_folder = import_shipper_folder(drive, shipper_folder_id, input)
-    report = running_redash(li_tracking_id, query_id, api_key)
+    cache = RedashCache(os.path.join(path, REDASH_CACHE_FILE), fresh=fresh)
+    client = RedashClient(api_key)
+    report = running_redash(li_tracking_id, query_id, client, cache=cache)
+    client.close()
+    cache.close()
 
     # report = pd.read_csv('report.csv').head(20)
 
+    # Remove characters which cannot be written to excel, before report is split by shipper
+    report = sanitize_report(report)
+    shipper_info = sanitize_report(shipper_info)
+
     report_shipper, report_full = merge_report(report, shipper_info, shipper_folder)
     report_dict = split_report(report_full)
 
-    done_export = pd.DataFrame()
-    cant_export = pd.DataFrame()
+    done_export = FrameAccumulator()
+    cant_export = FrameAccumulator()
     num_exported_folder = 0
 
+    # Files in Drive folders, listed in bulk once and reused by every lookup of this run
+    drive_index = DriveIndex(drive)
+    # Zip of the workbooks in internal folder, uploaded while the workbooks are built
+    archive = open_internal_archive(drive, internal_folder_id, drive_index)
+    # Workbooks built by this run, kept in memory
+    store = WorkbookStore(archive)
+    # Shipper's files uploaded today, a rerun skips them
+    journal = ExportJournal(os.path.join(path, EXPORT_JOURNAL_FILE), fresh=fresh)
+
     # Upload files belong to new shipper whose folder haven't existed in DRIVE
     li_new_shipper_id, li_new_folder_name, li_new_folder_link, done_export, cant_export = upload_type_2(
-        drive, report_shipper, shipper_folder, shipper_folder_id, path, directory, done_export, cant_export)
+        drive, report_shipper, shipper_folder, shipper_folder_id, store, done_export, cant_export, journal)
 
     # Upload files that belong to old shipper
     done_export, cant_export, num_exported_folder = upload_type_1(drive, report_full, report_dict, done_export, 
-                    cant_export, num_exported_folder, path, directory)
+                    cant_export, num_exported_folder, store, drive_index, journal)
 
     # Upload files that have error when uploading
-    error_export, success_flag = reup_cant_export_file(drive, cant_export, directory, done_export, report_dict, num_exported_folder, bi_key)
+    error_export, success_flag = reup_cant_export_file(drive, cant_export, store, done_export, report_dict, num_exported_folder, bi_key, drive_index, journal)
+    journal.close()
 
-    # Upload zip file to internal folder
-    upload_zip_to_internal_folder(path, directory, drive, internal_folder_id)
-    
-    # Remove created files in local storage
-    excel_file = "*.xlsx"
-    zip_file = "*.zip"
-    del_file_in_directory(directory, excel_file)
-    del_file_in_directory(directory, zip_file)
+    # Finish uploading zip file to internal folder
+    archive.close()
 
     # Check whether exporting process have an error
     if success_flag:
        output(output_sheet, li_new_shipper_id, li_new_folder_name, li_new_folder_link,
-       done_export, report, shipper_info, error_export)
+       done_export.concat(), report, shipper_info, error_export)
     else:
        print(f'!!! ERROR WHEN UPLOADING FILE, PLEASE RE-RUNNING TOOL !!!')
+    drive_limiter.report()
+    sheets_limiter.report()
     print(f'Execution time: {time.time() - start_time}')
 
 
 if __name__ == '__main__':
+    # Needed by worker processes of the packaged .exe
+    multiprocessing.freeze_support()
+
+    # Connect Drive
+    gc, drive = connect_drive(bi_key,auth,drive,gspread)
+
+    parser = argparse.ArgumentParser(description='HCO export tool')
+    parser.add_argument('--fresh', action='store_true', help='ignore cached Redash results and the journal of today, export every file again')
+    args = parser.parse_args()
+
     input("Press ENTER to run tool!")
-    main()
+    main(fresh=args.fresh)
     input("Press ENTER to close tool!")
\ No newline at end of file
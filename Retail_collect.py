@@ -2,18 +2,35 @@ import pandas as pd
 import os
 import pathlib
 import time
+import random
+import threading
+import multiprocessing
+import sqlite3
+import pickle
+import argparse
+import json
+from io import BytesIO
 from tenacity import *
-from datetime import datetime
-from openpyxl import Workbook
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime, date
+from pandas.io.parsers import TextParser
+from openpyxl import Workbook, load_workbook
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import gspread
+from gspread.utils import absolute_range_name, rowcol_to_a1
 from google.oauth2 import service_account
 from pydrive import auth, drive
 pd.options.mode.chained_assignment = None
 
+# python-calamine reads .xlsx files much faster than openpyxl, use it when installed
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
 # COMMON FUNCTION
 # ==================================================================
 def connect_drive(bi_key, auth, drive, gspread):
@@ -27,88 +44,778 @@ def connect_drive(bi_key, auth, drive, gspread):
     print("Connected to DRIVE!")
     return gc, drive
 
+# Google API quota: requests allowed per 100 seconds, shared by all threads
+DRIVE_QUOTA = 1000
+SHEETS_QUOTA = 300
+# Max requests sent at once after being idle
+API_BURST = 20
+# Retries of a request rejected by quota, waiting 1, 2, 4.. (max 64) seconds in between
+QUOTA_RETRIES = 8
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED', 'RESOURCE_EXHAUSTED')
+
+class TokenBucket:
+    """
+    Rate limiter shared by all threads
+    Tokens are added at quota/100 per second up to `capacity`; take() waits until a token is available
+    Counters:
+    - throttled: seconds spent waiting for a token
+    - backoff, retries: seconds spent backing off / number of retries after quota errors
+    """
+    def __init__(self, name, quota, capacity=API_BURST):
+        self.name = name
+        self.rate = quota / 100
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.backoff = 0
+        self.retries = 0
+
+    def take(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve n tokens, wait outside the lock until they are refilled
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+            if wait > 0:
+                self.throttled += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def add_backoff(self, seconds):
+        with self.lock:
+            self.backoff += seconds
+            self.retries += 1
+
+    def report(self):
+        print(f'{self.name} API: throttled {self.throttled:.1f}s, '
+              f'backoff {self.backoff:.1f}s after {self.retries} quota errors')
+
+drive_limiter = TokenBucket('Drive', DRIVE_QUOTA)
+sheets_limiter = TokenBucket('Sheets', SHEETS_QUOTA)
+
+def is_quota_error(e):
+    # PyDrive raises ApiRequestError(HttpError) - status in resp.status, reason in content
+    # gspread raises APIError - status in response.status_code, reason in its message
+    for err in (e, *e.args):
+        status = getattr(getattr(err, 'resp', None), 'status', None) or \
+            getattr(getattr(err, 'response', None), 'status_code', None)
+        if status is not None:
+            detail = str(err) + str(getattr(err, 'content', ''))
+            return int(status) == 429 or (int(status) == 403 and any(r in detail for r in QUOTA_REASONS))
+    return False
+
+def count_backoff(retry_state):
+    retry_state.args[0].add_backoff(retry_state.next_action.sleep)
+
+@retry(retry=retry_if_exception(is_quota_error), wait=wait_random_exponential(multiplier=1, max=64),
+       stop=stop_after_attempt(QUOTA_RETRIES), before_sleep=count_backoff, reraise=True)
+def google_call(limiter, func, *args, **kwargs):
+    """
+    Send one Drive/Sheets request within the quota:
+    - take a token from limiter before the request
+    - retry with exponential backoff when the request is rejected by quota (403 rateLimitExceeded / 429)
+
+    Input: limiter, function sending the request and its arguments
+
+    Output: result of func
+    """
+    limiter.take()
+    return func(*args, **kwargs)
+
+def drive_call(func, *args, **kwargs):
+    return google_call(drive_limiter, func, *args, **kwargs)
+
+def sheets_call(func, *args, **kwargs):
+    return google_call(sheets_limiter, func, *args, **kwargs)
+
+# Max folders OR-ed in one files.list query, keeps the query under the URL length limit
+INDEX_PARENTS_PER_QUERY = 50
+INDEX_FIELDS = 'nextPageToken,items(id,title,parents(id),createdDate,modifiedDate,md5Checksum)'
+
+def list_pages(file_list):
+    # Send one request (and take one token) per page, so a page rejected by quota is retried alone
+    li_files = []
+    for page in iter(lambda: drive_call(next, file_list, None), None):
+        li_files.extend(page)
+    return li_files
+
+class DriveIndex:
+    """
+    Files in many Drive folders, listed in bulk and cached for the run
+    - load(): list children of INDEX_PARENTS_PER_QUERY folders per files.list query,
+      a query which fails is sent again for each of its folders, folders which still fail are left out
+    - get(): children of one folder, listed on first use if the folder was not loaded
+    - add()/remove(): keep the cache in sync with files uploaded/deleted during the run
+    Only id, title, parents, createdDate, modifiedDate and md5Checksum of the files are fetched
+    """
+    def __init__(self, drive):
+        self.drive = drive
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def list_children(self, chunk):
+        # list files of the folders in chunk with one query, raise if any page fails
+        q = ' or '.join(f"'{i}' in parents" for i in chunk)
+        li_files = list_pages(self.drive.ListFile(
+            {'q': f"({q}) and trashed=false", 'fields': INDEX_FIELDS, 'maxResults': 1000}))
+
+        children = {i: [] for i in chunk}
+        for file in li_files:
+            for parent in file['parents']:
+                if parent['id'] in children:
+                    children[parent['id']].append(file)
+        with self.lock:
+            self.children.update(children)
+
+    def load(self, li_parents_id):
+        li_parents_id = [i for i in dict.fromkeys(li_parents_id) if i not in self.children]
+        for k in range(0, len(li_parents_id), INDEX_PARENTS_PER_QUERY):
+            chunk = li_parents_id[k:k + INDEX_PARENTS_PER_QUERY]
+            try:
+                self.list_children(chunk)
+            except Exception as e:
+                # a failed page or one bad folder id fails the whole query:
+                # list the folders of the chunk one at a time so only the bad ones are missing
+                print(e)
+                print(f'Error when listing {len(chunk)} folders, listing them one by one')
+                for parents_id in chunk:
+                    try:
+                        self.list_children([parents_id])
+                    except Exception as e:
+                        print(e)
+                        print(f'Error when listing folder {parents_id}')
+
+    def get(self, parents_id):
+        # raise if the folder cannot be listed
+        if parents_id not in self.children:
+            self.list_children([parents_id])
+        with self.lock:
+            return list(self.children[parents_id])
+
+    def add(self, parents_id, file):
+        with self.lock:
+            if parents_id in self.children:
+                self.children[parents_id].append(file)
+
+    def remove(self, parents_id, file_id):
+        with self.lock:
+            if parents_id in self.children:
+                self.children[parents_id] = [file for file in self.children[parents_id] if file['id'] != file_id]
+
+# Max deletions sent in one batch request (Drive allows 100)
+DELETE_BATCH_SIZE = 100
+
+def is_retryable_error(e):
+    # quota errors and Drive server errors (500, 502, 503..) may succeed when sent again later
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    return is_quota_error(e) or (status is not None and int(status) >= 500)
+
+def batch_delete_files(drive, li_file_id):
+    """
+    Delete files with batch requests of DELETE_BATCH_SIZE deletions, instead of one request per file
+    - every deletion in a batch has its own result, only the failed ones are sent again
+      (with exponential backoff) when they were rejected by quota or a server error
+    - a file which was already deleted (404) counts as deleted
+    PyDrive builds a Drive v2 service, so v2 files.delete requests are batched
+
+    Input: drive, list of file id
+
+    Output: dictionary of {file id: exception} of files which could not be deleted
+    """
+    if drive.auth.service is None:
+        drive.auth.Authorize()
+    service = drive.auth.service
+
+    li_file_id = list(dict.fromkeys(li_file_id))
+    failed = {}
+    for attempt in range(QUOTA_RETRIES):
+        # result of files sent again replaces their previous error
+        for file_id in li_file_id:
+            failed.pop(file_id, None)
+
+        def callback(request_id, response, exception):
+            if exception is not None and getattr(getattr(exception, 'resp', None), 'status', None) != 404:
+                failed[request_id] = exception
+
+        for k in range(0, len(li_file_id), DELETE_BATCH_SIZE):
+            chunk = li_file_id[k:k + DELETE_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for file_id in chunk:
+                batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+            # every deletion in the batch counts against the quota
+            drive_limiter.take(len(chunk))
+            try:
+                # own http object, the one shared by PyDrive is not thread-safe
+                batch.execute(http=drive.auth.Get_Http_Object())
+            except Exception as e:
+                for file_id in chunk:
+                    failed.setdefault(file_id, e)
+
+        li_file_id = [file_id for file_id in li_file_id if file_id in failed and is_retryable_error(failed[file_id])]
+        if not li_file_id or attempt == QUOTA_RETRIES - 1:
+            break
+        wait = min(64, 2 ** attempt) * random.uniform(0.5, 1)
+        drive_limiter.add_backoff(wait)
+        time.sleep(wait)
+    return failed
+
+class FrameAccumulator:
+    """
+    Collect dataframes in a list and concat them once at the end,
+    instead of calling pd.concat in a loop (which copies the growing frame every time)
+    """
+    def __init__(self):
+        self.frames = []
+
+    def append(self, df):
+        self.frames.append(df)
+
+    def __len__(self):
+        # number of rows collected
+        return sum(df.shape[0] for df in self.frames)
+
+    def concat(self, **kwargs) -> pd.DataFrame:
+        if not self.frames:
+            return pd.DataFrame()
+        return pd.concat(self.frames, **kwargs)
+
 # HCO COLLECT RESPONSE TOOL
 # ==================================================================
 def get_li_files(drive, parents_id):
-    return drive.ListFile(
+    return drive_call(lambda: drive.ListFile(
         {'q' : f"'{parents_id}' in parents and trashed=false"}
-    ).GetList()
+    ).GetList())
 def read_gsheet(gc, sheet_id, ws_name):
-    sheet = gc.open_by_key(sheet_id)
-    worksheet = sheet.worksheet(ws_name)
-    return pd.DataFrame(worksheet.get_all_records())
-def collect_responses(drive, done_export):
+    sheet = sheets_call(gc.open_by_key, sheet_id)
+    worksheet = sheets_call(sheet.worksheet, ws_name)
+    return pd.DataFrame(sheets_call(worksheet.get_all_records))
+# Threads listing and downloading files of shipper's folders
+DRIVE_WORKERS = 4
+# Processes parsing the downloaded excel files
+PARSE_WORKERS = os.cpu_count() or 1
+
+# Number of columns read from each shipper's response
+RESPONSE_COLUMNS = 12
+
+def find_today_file(drive_index, folder_id, cur_date):
+    # today's file of one shipper's folder, KeyError if there is none
+    li_files = drive_index.get(folder_id)
+    # dict = {file['title'][-21:-11]: file for file in li_files}
+    dict = {f"{file['title'][-15:-5]}": file for file in li_files}
+    return dict[f'{cur_date}']
+def download_response(drive, file_id):
+    # download content of one shipper's file into memory (run in a Drive thread)
+    file = drive.CreateFile({'id': file_id})
+    drive_call(file.FetchContent)
+    return file.content.getvalue()
+def convert_cell(value):
+    # convert value of a cell as pandas' excel readers do
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    return value
+def read_sheet_rows(data) -> list:
+    # values of the first RESPONSE_COLUMNS columns of every row in first sheet
+    if CalamineWorkbook is not None:
+        sheet = CalamineWorkbook.from_filelike(BytesIO(data)).get_sheet_by_index(0)
+        return [[convert_cell(value) for value in row[:RESPONSE_COLUMNS]]
+                for row in sheet.to_python(skip_empty_area=False)]
+
+    workbook = load_workbook(BytesIO(data), read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+        # error cells (#REF!, #DIV/0!...) are read as NaN
+        return [[float('nan') if cell.data_type == 'e' else convert_cell(cell.value) for cell in row]
+                for row in sheet.iter_rows(max_col=RESPONSE_COLUMNS)]
+    finally:
+        workbook.close()
+def parse_response(data) -> pd.DataFrame:
+    """
+    Read response of one shipper from the content of its .xlsx file (run in a worker process)
+    Only the first RESPONSE_COLUMNS columns are read, by python-calamine when installed,
+    otherwise by openpyxl in read-only mode
+
+    Input: content of .xlsx file
+    Output: same dataframe as pd.read_excel(file, usecols=range(RESPONSE_COLUMNS))
+    """
+    rows = read_sheet_rows(data)
+    # drop empty cells at the end of rows and empty rows at the end of sheet, like pd.read_excel
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    if not rows:
+        return pd.DataFrame()
+    width = max(len(row) for row in rows)
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    return TextParser(rows, header=0, usecols=[i for i in range(RESPONSE_COLUMNS)], skip_blank_lines=False).read()
+# Responses collected today, a rerun only downloads files modified since they were collected
+RESPONSE_CACHE_FILE = 'response_cache.sqlite'
+
+class ResponseCache:
+    """
+    On-disk store (SQLite) of the last collected response of every shipper's folder
+
+    Key: folder id; watermark: id, modifiedDate and md5Checksum of the collected file
+    - get(): saved response of the folder, None if its file was changed since it was collected
+    - put(): save watermark and response of the folder
+    - responses of other HCO dates are removed on open
+    - fresh=True: do not read saved responses (new responses are still saved)
+    """
+    def __init__(self, file_name, hco_date, fresh=False):
+        self.hco_date = hco_date
+        self.fresh = fresh
+        self.conn = sqlite3.connect(file_name)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS response (
+            folder_id TEXT PRIMARY KEY, hco_date TEXT, file_id TEXT, modified_date TEXT, md5 TEXT, data BLOB)""")
+        self.conn.execute('DELETE FROM response WHERE hco_date != ?', (hco_date,))
+        self.conn.commit()
+
+    @staticmethod
+    def watermark(file) -> tuple:
+        return file['id'], file.get('modifiedDate'), file.get('md5Checksum')
+
+    def get(self, folder_id, file):
+        if self.fresh:
+            return None
+        row = self.conn.execute(
+            'SELECT file_id, modified_date, md5, data FROM response WHERE folder_id = ? AND hco_date = ?',
+            (folder_id, self.hco_date)).fetchone()
+        if row is None or tuple(row[:3]) != self.watermark(file):
+            return None
+        return pickle.loads(row[3])
+
+    def put(self, folder_id, file, df):
+        data = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        self.conn.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)',
+                          (folder_id, self.hco_date) + self.watermark(file) + (data,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def fetch_responses(drive, files, cache) -> dict:
+    """
+    Responses of shipper's files, taken from cache when the file is not changed since it was collected
+    - a pool of DRIVE_WORKERS threads downloads the other files into memory
+    - each downloaded file is parsed by a pool of PARSE_WORKERS processes,
+      while the next files are still being downloaded
+
+    Input:
+    - files: dictionary of today's file by folder id
+    - cache: ResponseCache of today
+
+    Output: dictionary of response by folder id, folders whose file cannot be read are printed and left out
+    """
+    responses = {}
+    downloads = {}
+    with ThreadPoolExecutor(max_workers=DRIVE_WORKERS) as drive_pool, \
+            ProcessPoolExecutor(max_workers=PARSE_WORKERS) as parse_pool:
+        for folder_id, file in files.items():
+            rp = cache.get(folder_id, file)
+            if rp is not None:
+                responses[folder_id] = rp
+            else:
+                downloads[drive_pool.submit(download_response, drive, file['id'])] = folder_id, file
+        print(f'{len(downloads)} changed files to download, {len(responses)} files unchanged since last collect')
+
+        parses = {}
+        for future in as_completed(downloads):
+            folder_id, file = downloads[future]
+            try:
+                parses[parse_pool.submit(parse_response, future.result())] = folder_id, file
+            except Exception as e:
+                print(e)
+                print(f'Không tìm thấy file trong folder {folder_id}')
+
+        for future in as_completed(parses):
+            folder_id, file = parses[future]
+            try:
+                responses[folder_id] = future.result()
+                cache.put(folder_id, file, responses[folder_id])
+            except Exception as e:
+                print(e)
+                print(f'Không tìm thấy file trong folder {folder_id}')
+    return responses
+def concat_responses(responses, li_folder_id) -> pd.DataFrame:
+    # one dataframe of responses, in the order of folders in li_folder_id
+    report = FrameAccumulator()
+    for folder_id in li_folder_id:
+        if folder_id in responses:
+            report.append(responses[folder_id])
+    return report.concat()
+def collect_folder_responses(drive, li_folder_id, cache) -> tuple:
+    """
+    Collect today's response of every shipper's folder in li_folder_id
+    Folders are listed in bulk, then files are read by fetch_responses
+
+    Output: (dictionary of response by folder id, dictionary of today's file by folder id)
+    """
     print("Collecting files from shipper's folders. It might take a while...")
-    report = pd.DataFrame()
-    dict = {}
+    files = {}
 
     cur_date = datetime.today().strftime("%d-%m-%Y")
 
-    for folder_id in list(set(done_export['f_id'])):
-        try:
-            li_files = drive.ListFile(
-                {'q': f"'{folder_id}' in parents and trashed=false"}).GetList()
-            # dict = {file['title'][-21:-11]: file['id'] for file in li_files}
-            dict = {f"{file['title'][-15:-5]}": file['id'] for file in li_files}
-        except Exception as e:
-            print(f'{e}')
+    # list files of all shipper's folders in a few bulk queries
+    drive_index = DriveIndex(drive)
+    drive_index.load(li_folder_id)
 
+    for folder_id in li_folder_id:
         try:
-            file = drive.CreateFile({'id': dict[f'{cur_date}']})
-            file.GetContentFile(file['title'])
-            rp = pd.read_excel(file['title'], usecols=[i for i in range(12)])
-            report = pd.concat([report, rp])
+            files[folder_id] = find_today_file(drive_index, folder_id, cur_date)
         except Exception as e:
             print(e)
             print(f'Không tìm thấy file trong folder {folder_id}')
+
+    responses = fetch_responses(drive, files, cache)
     print("Done collect response!")
-    return report, dict
-def del_local_files(dir):
-    for file_path in dir.rglob("CO*"):
-        try:
-            os.remove(file_path)
-        except Exception as e:
-            print(e)
+    return responses, files
+def collect_responses(drive, done_export, cache):
+    """
+    Collect today's response of every shipper's folder in done_export
+
+    Input:
+    - done_export: dataframe of exported shipper's folders, with column 'f_id'
+    - cache: ResponseCache of today
+
+    Output: (dataframe of all responses, in the order of folders in done_export,
+             dictionary of today's file id by folder)
+    """
+    li_folder_id = done_export['f_id'].drop_duplicates().tolist()
+    responses, files = collect_folder_responses(drive, li_folder_id, cache)
+    return concat_responses(responses, li_folder_id), {folder_id: file['id'] for folder_id, file in files.items()}
+# Mime type of Google Sheets files
+GSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+
+def remove_files(drive, li_files):
+    failed = batch_delete_files(drive, [file['id'] for file in li_files])
+    for file in li_files:
+        if file['id'] in failed:
+            print(failed[file['id']])
+            print(f'Error when deleting "{file["title"]}"')
+        else:
+            print(f'Deleted "{file["title"]}"')
+def find_today_sheet(drive, parents_id, hco_filename):
+    """
+    Response gsheet of today in folder Shipper response, to be updated instead of creating a new one
+    Other files of today are removed to prevent duplicated response file
 
-def remove_today_file(drive, parents_id):
+    Output: file of the gsheet, None if it does not exist yet
+    """
     cur_date = datetime.today().strftime("%d-%m-%Y")
 
     li_files = get_li_files(drive, parents_id)
-    li_files = [file for file in li_files if file['title'][:10] == cur_date]
-    for file in li_files:
-        del_file = drive.CreateFile({'id': file['id']})
-        del_file.Delete()
-        print(f'Deleted "{file["title"]}"')
+    li_files = sorted([file for file in li_files if file['title'][:10] == cur_date], key=lambda file: file['createdDate'])
+    li_sheets = [file for file in li_files if file['title'] == hco_filename and file['mimeType'] == GSHEET_MIME_TYPE]
+    sheet_file = li_sheets[0] if li_sheets else None
+    li_duplicated_files = [file for file in li_files if file is not sheet_file]
+    if len(li_duplicated_files) > 0:
+        remove_files(drive, li_duplicated_files)
+    return sheet_file
+
+def format_responses(responses) -> list:
+    # header and rows of responses, with all column values converted into string
+    responses = responses.copy()
+    for col in responses.columns:
+        responses[col] = responses[col].astype(str)
+    return [responses.columns.values.tolist()] + responses.values.tolist()
+
+# Column identifying a row of responses (tracking id)
+RESPONSE_KEY = 'Mã'
+# Max cells sent in one values.batchUpdate request (request body is limited by Sheets API)
+SHEETS_BATCH_CELLS = 200000
+
+def upsert_rows(old_rows, new_rows, key=RESPONSE_KEY, removed_keys=()) -> list:
+    """
+    Rows of the sheet after upserting new_rows into old_rows (first row of both is the header)
+    - row whose key is already in the sheet is updated in place, rows of new keys are added at the end
+    - rows of the sheet whose key is not in new_rows are kept, except for keys in removed_keys:
+      rows of these keys which are not in new_rows anymore are deleted
+    - columns are matched by name, new columns are added at the right
+    A key found n times is matched with its n-th row in the sheet
+    If new_rows has no key column or no row (every download failed, no file today), the sheet is kept
+    and only rows of removed_keys are deleted
+    If the sheet is empty or has no key column, it is replaced by new_rows
+    """
+    if len(new_rows) < 2 or key not in new_rows[0]:
+        if not old_rows or key not in old_rows[0]:
+            return old_rows
+        new_rows = [[key]]
+    if not old_rows or key not in old_rows[0]:
+        return new_rows
+    header = old_rows[0] + [col for col in new_rows[0] if col not in old_rows[0]]
+    li_col = [header.index(col) for col in new_rows[0]]
+    rows = [row + [''] * (len(header) - len(row)) for row in old_rows[1:]]
+
+    old_key, new_key = header.index(key), new_rows[0].index(key)
+    if removed_keys:
+        new_count = {}
+        for new_row in new_rows[1:]:
+            new_count[new_row[new_key]] = new_count.get(new_row[new_key], 0) + 1
+        count = {}
+        kept_rows = []
+        for row in rows:
+            if row[old_key] in removed_keys:
+                count[row[old_key]] = count.get(row[old_key], 0) + 1
+                if count[row[old_key]] > new_count.get(row[old_key], 0):
+                    continue
+            kept_rows.append(row)
+        rows = kept_rows
+
+    positions = {}
+    count = {}
+    for i, row in enumerate(rows):
+        count[row[old_key]] = count.get(row[old_key], -1) + 1
+        positions[(row[old_key], count[row[old_key]])] = i
+
+    count = {}
+    for new_row in new_rows[1:]:
+        count[new_row[new_key]] = count.get(new_row[new_key], -1) + 1
+        i = positions.get((new_row[new_key], count[new_row[new_key]]))
+        if i is None:
+            row = [''] * len(header)
+            rows.append(row)
+        else:
+            row = rows[i]
+        for col, value in zip(li_col, new_row):
+            row[col] = value
+    return [header] + rows
+
+class ResponseSheet:
+    """
+    Response gsheet of today, updated in place
+    Rows currently in the sheet are kept in memory: update() only sends the rows which changed,
+    each run of consecutive changed rows is one range of a values.batchUpdate,
+    with at most SHEETS_BATCH_CELLS cells per request
+    """
+    def __init__(self, worksheet, rows):
+        self.worksheet = worksheet
+        self.rows = rows
+
+    def upsert(self, rows, removed_keys=()) -> int:
+        # upsert rows by RESPONSE_KEY (see upsert_rows), output: number of rows sent
+        return self.update(upsert_rows(self.rows, rows, removed_keys=removed_keys))
+
+    def update(self, rows) -> int:
+        # replace rows of the sheet, output: number of rows sent
+        width = max([len(row) for row in rows + self.rows] + [1])
+        old = [row + [''] * (width - len(row)) for row in self.rows]
+        # rows which are not in the new rows anymore are blanked
+        new = [row + [''] * (width - len(row)) for row in rows] + [[''] * width] * (len(old) - len(rows))
 
-def export_responses(gc, drive, responses, res_folder_id):
-    # Remove file of today to prevent duplicated response file
-    remove_today_file(drive, res_folder_id)
+        # (first row, values) of each run of changed rows, split to fit in one request
+        li_range = []
+        step = max(1, SHEETS_BATCH_CELLS // width)
+        start = None
+        for i in range(len(new) + 1):
+            if i < len(new) and (i >= len(old) or new[i] != old[i]):
+                if start is None:
+                    start = i
+            elif start is not None:
+                li_range.extend((k, new[k:min(k + step, i)]) for k in range(start, i, step))
+                start = None
 
-    # Get list of existed files in folder Shipper response
-    hco_files = drive.ListFile(
-        {'q': f"'{res_folder_id}' in parents and trashed=false"}).GetList()
-    hco_dict = {file['title'][:10]: file['id'] for file in hco_files}
-    # print(f'HCO dict = {hco_dict}')
+        if li_range:
+            if len(new) > self.worksheet.row_count:
+                sheets_call(self.worksheet.add_rows, len(new) - self.worksheet.row_count)
+            if width > self.worksheet.col_count:
+                sheets_call(self.worksheet.add_cols, width - self.worksheet.col_count)
+            data, cells = [], 0
+            for k, values in li_range:
+                if data and cells + len(values) * width > SHEETS_BATCH_CELLS:
+                    self.send(data)
+                    data, cells = [], 0
+                data.append({'range': absolute_range_name(self.worksheet.title, rowcol_to_a1(k + 1, 1)), 'values': values})
+                cells += len(values) * width
+            self.send(data)
+        self.rows = rows
+        return sum(len(values) for k, values in li_range)
 
+    def send(self, data):
+        sheets_call(self.worksheet.spreadsheet.values_batch_update,
+                    body={'valueInputOption': 'RAW', 'data': data})
+
+def export_responses(gc, drive, responses, res_folder_id) -> ResponseSheet:
+    """
+    Upsert responses into the response gsheet of today by tracking id (RESPONSE_KEY)
+    Gsheet of today is reused when it exists: its rows are read once and only changed rows are sent
+    Rows of the sheet which are not in responses are kept, so a file which could not be read
+    this run does not remove its rows collected by an earlier run
+
+    Output: ResponseSheet of the gsheet
+    """
     # Setup file name
     hco_date = datetime.today().strftime("%d-%m-%Y")
 
     hco_filename = hco_date + "_HCO_shipper_response"
     print("HCO shipper response file name: ", hco_filename)
 
-    # Convert all column values into string
-    for col in responses.columns:
-        responses[col] = responses[col].astype(str)
+    sheet_file = find_today_sheet(drive, res_folder_id, hco_filename)
+    if sheet_file is None:
+        print("Create new shipper response gsheet: ", hco_filename)
+        gsheet = sheets_call(gc.create, hco_filename, folder_id = res_folder_id)
+        worksheet = sheets_call(gsheet.get_worksheet, 0)
+        rows = []
+    else:
+        print("Update shipper response gsheet: ", hco_filename)
+        gsheet = sheets_call(gc.open_by_key, sheet_file['id'])
+        worksheet = sheets_call(gsheet.get_worksheet, 0)
+        rows = sheets_call(worksheet.get_all_values)
+
+    sheet = ResponseSheet(worksheet, rows)
+    num_rows = sheet.upsert(format_responses(responses))
+    print(f'{num_rows} rows updated')
+    return sheet
+
+# WATCH MODE
+# Seconds between two reads of Drive changes feed
+WATCH_INTERVAL = 60
+# Page token of Drive changes feed, a restarted watcher continues from where it stopped
+WATCH_TOKEN_FILE = 'watch_token.json'
+CHANGES_FIELDS = ('nextPageToken,newStartPageToken,'
+                  'items(fileId,deleted,file(id,title,parents(id),modifiedDate,md5Checksum,labels(trashed)))')
+
+class DriveChanges:
+    """
+    Changes of files seen by the service account, read from Drive changes.list
+
+    - start(): continue from page token saved today, or start from the current state of Drive
+    - poll(): changes since the page token, every page of the feed is read
+    - save(): move page token after the changes returned by poll() and save it to file_name
+    Another object with the same methods can replay a recorded feed instead of Drive
+    """
+    def __init__(self, drive, file_name, hco_date):
+        self.drive = drive
+        self.file_name = file_name
+        self.hco_date = hco_date
+        self.page_token = None
+        self.new_page_token = None
+
+    def changes(self):
+        # changes.list is not wrapped by PyDrive, authorize it before using its service
+        if self.drive.auth.service is None:
+            self.drive.auth.Authorize()
+        return self.drive.auth.service.changes()
+
+    def start(self):
+        if os.path.exists(self.file_name):
+            with open(self.file_name, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('hco_date') == self.hco_date:
+                self.page_token = saved['page_token']
+        if self.page_token is None:
+            self.page_token = drive_call(
+                lambda: self.changes().getStartPageToken().execute(http=self.drive.auth.Get_Http_Object())
+            )['startPageToken']
+            self.new_page_token = self.page_token
+            self.save()
+
+    def poll(self) -> list:
+        li_changes = []
+        page_token = self.page_token
+        while True:
+            page = drive_call(lambda: self.changes().list(
+                pageToken=page_token, fields=CHANGES_FIELDS, maxResults=1000).execute(
+                http=self.drive.auth.Get_Http_Object()))
+            li_changes.extend(page.get('items', []))
+            if page.get('nextPageToken'):
+                page_token = page['nextPageToken']
+            else:
+                self.new_page_token = page['newStartPageToken']
+                return li_changes
+
+    def save(self):
+        self.page_token = self.new_page_token
+        with open(self.file_name, 'w', encoding='utf-8') as f:
+            json.dump({'hco_date': self.hco_date, 'page_token': self.page_token}, f)
 
-    print("Create new shipper response gsheet: ", hco_filename)
-    gsheet = gc.create(hco_filename, folder_id = res_folder_id)
-    sheet = gc.open_by_key(gsheet.id)
-    worksheet = sheet.get_worksheet(0)
-    worksheet.clear()
-    worksheet.update([responses.columns.values.tolist()] + responses.values.tolist())
+def read_changes(changes, files, folders, hco_date) -> tuple:
+    """
+    Today's files of shipper's folders which are changed or removed in the changes feed
+
+    Input:
+    - changes: DriveChanges
+    - files: dictionary of today's file by folder id, collected so far
+    - folders: set of shipper's folder id
+
+    Output: (dictionary of changed file by folder id, set of folder id whose file was removed)
+    """
+    changed = {}
+    removed = set()
+    for change in changes.poll():
+        file = change.get('file') or {}
+        if change.get('deleted') or file.get('labels', {}).get('trashed'):
+            for folder_id, f in list(files.items()) + list(changed.items()):
+                if f['id'] == change['fileId']:
+                    changed.pop(folder_id, None)
+                    removed.add(folder_id)
+            continue
+        for parent in file.get('parents', []):
+            if parent['id'] in folders and file['title'][-15:-5] == hco_date:
+                changed[parent['id']] = file
+                removed.discard(parent['id'])
+    return changed, removed
+
+def watch_responses(gc, drive, done_export, cache, res_folder_id, changes, interval=WATCH_INTERVAL):
+    """
+    Collect responses, then keep the response gsheet of today up to date until the end of the day
+    (or Ctrl+C): every interval seconds, Drive changes feed is read and only today's files
+    changed in shipper's folders are downloaded and parsed again
+    Rows of a changed file are upserted; rows deleted from the file, and all rows of a removed file,
+    are deleted from the sheet
+
+    Input:
+    - done_export: dataframe of exported shipper's folders, with column 'f_id'
+    - cache: ResponseCache of today
+    - res_folder_id: id of folder Shipper response
+    - changes: DriveChanges, or a stub replaying a recorded feed
+    """
+    hco_date = datetime.today().strftime("%d-%m-%Y")
+    li_folder_id = done_export['f_id'].drop_duplicates().tolist()
+    folders = set(li_folder_id)
+
+    # changes are read from before the first collect, so edits made during it are not missed
+    changes.start()
+    responses, files = collect_folder_responses(drive, li_folder_id, cache)
+    response_df = concat_responses(responses, li_folder_id).fillna('-')
+    sheet = export_responses(gc, drive, response_df, res_folder_id)
+
+    print(f'Watching shipper\'s folders for changes every {interval} seconds, press Ctrl+C to stop')
+    try:
+        while datetime.today().strftime("%d-%m-%Y") == hco_date:
+            time.sleep(interval)
+            changed, removed = read_changes(changes, files, folders, hco_date)
+            if changed or removed:
+                # keys of the previous responses of these files, their rows which are gone are deleted
+                removed_keys = set()
+                for folder_id in list(changed) + list(removed):
+                    if folder_id in responses and RESPONSE_KEY in responses[folder_id]:
+                        removed_keys.update(responses[folder_id][RESPONSE_KEY].fillna('-').astype(str))
+                for folder_id in removed:
+                    responses.pop(folder_id, None)
+                    files.pop(folder_id, None)
+                files.update(changed)
+                # a file which cannot be read keeps its previous response until it is changed again
+                if changed:
+                    responses.update(fetch_responses(drive, changed, cache))
+                num_rows = sheet.upsert(format_responses(concat_responses(responses, li_folder_id).fillna('-')),
+                                        removed_keys)
+                print(f'{datetime.now().strftime("%H:%M:%S")} {len(changed)} changed, {len(removed)} removed files, '
+                      f'{num_rows} rows updated')
+            changes.save()
+    except KeyboardInterrupt:
+        print('Stopped watching')
 
 path = pathlib.Path().absolute()
-directory = pathlib.Path(path)
 start_time = time.time()
 bi_key = {
     "type": "service_account",
@@ -123,10 +830,7 @@ bi_key = {
     "client_x509_cert_url": "https://www.googleapis.com/robot/v1/metadata/x509/vn-bi-6th%40vn-bi-337205.iam.gserviceaccount.com"
 }
 
-# Connect Drive
-gc, drive = connect_drive(bi_key,auth,drive,gspread)
-
-def main():
+def main(fresh=False, watch=False):
     # Read sheet done_export into dataframe
 
     output_sheet_id = "1fIO9ojUpmbXCmw_pPrLLvSY-BvYyL_CdJSuEdbvhKN8"
@@ -139,23 +843,40 @@ def main():
     hco_date = datetime.today().strftime("%d-%m-%Y")
     print("HCO date: ",hco_date)
 
-    # Collect responses by Timeslot
-    response_df, dict = collect_responses(drive, done_export)
-
-    # Delete local collected files
-    del_local_files(directory)
+    # Collect responses by Timeslot, files not changed since the last run are not downloaded again
+    cache = ResponseCache(os.path.join(path, RESPONSE_CACHE_FILE), hco_date, fresh=fresh)
+    if watch:
+        # Keep the response gsheet up to date with Drive changes feed
+        changes = DriveChanges(drive, os.path.join(path, WATCH_TOKEN_FILE), hco_date)
+        watch_responses(gc, drive, done_export, cache, response_folder_id, changes)
+    else:
+        response_df, dict = collect_responses(drive, done_export, cache)
 
-    # Fill na value by "-""
-    response_df.fillna('-', inplace=True)
-    print(response_df.shape)
+        # Fill na value by "-""
+        response_df.fillna('-', inplace=True)
+        print(response_df.shape)
 
-    # Export to Googlesheet
-    export_responses(gc, drive, response_df, response_folder_id)
+        # Export to Googlesheet
+        export_responses(gc, drive, response_df, response_folder_id)
+    cache.close()
 
+    drive_limiter.report()
+    sheets_limiter.report()
     print(f'Execution time: {time.time() - start_time}')
 
 
 if __name__ == '__main__':
+    # Needed by worker processes of the packaged .exe
+    multiprocessing.freeze_support()
+
+    # Connect Drive
+    gc, drive = connect_drive(bi_key,auth,drive,gspread)
+
+    parser = argparse.ArgumentParser(description='HCO collect response tool')
+    parser.add_argument('--fresh', action='store_true', help='ignore responses collected by previous runs of today, download every file again')
+    parser.add_argument('--watch', action='store_true', help='keep the response gsheet of today up to date with Drive changes feed until the end of the day')
+    args = parser.parse_args()
+
     input("Press ENTER to run tool!")
-    main()
+    main(fresh=args.fresh, watch=args.watch)
     input("Press ENTER to close tool!")
\ No newline at end of file
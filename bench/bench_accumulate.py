@@ -0,0 +1,68 @@
+"""
+Benchmark of collecting Redash result chunks: FrameAccumulator against pd.concat in a loop
+
+report.csv is scaled up and cut into chunks of REDASH_CHUNK_SIZE rows, as running_redash receives them.
+For each scale, the chunks are collected:
+- loop: report = pd.concat([report, rp], ignore_index=True) after each chunk, as before
+- accumulator: FrameAccumulator.append() after each chunk, one concat at the end
+Time and peak memory (tracemalloc) are printed, the time of the loop grows with the square of the scale
+
+Run from the repo root: python bench/bench_accumulate.py [--scales 10 50 100]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from Retail_export import FrameAccumulator, REDASH_CHUNK_SIZE
+
+
+def chunks(report, scale):
+    report = pd.concat([report] * scale, ignore_index=True)
+    return [report.iloc[k:k + REDASH_CHUNK_SIZE].copy() for k in range(0, len(report), REDASH_CHUNK_SIZE)]
+
+
+def concat_loop(li_rp):
+    report = pd.DataFrame()
+    for rp in li_rp:
+        report = pd.concat([report, rp], ignore_index=True)
+    return report
+
+
+def accumulate(li_rp):
+    report = FrameAccumulator()
+    for rp in li_rp:
+        report.append(rp)
+    return report.concat(ignore_index=True)
+
+
+def measure(func, li_rp):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(li_rp)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 50, 100])
+    args = parser.parse_args()
+
+    report = pd.read_csv(os.path.join(ROOT, 'report.csv'), index_col=0)
+    print(f'report.csv: {len(report)} rows, chunks of {REDASH_CHUNK_SIZE} rows')
+    print(f"{'scale':>6} {'rows':>9} {'chunks':>7} | {'loop s':>8} {'loop MB':>8} | {'acc s':>8} {'acc MB':>8}")
+    for scale in args.scales:
+        li_rp = chunks(report, scale)
+        loop, loop_time, loop_peak = measure(concat_loop, li_rp)
+        acc, acc_time, acc_peak = measure(accumulate, li_rp)
+        pd.testing.assert_frame_equal(loop, acc)
+        print(f'{scale:>6} {len(acc):>9} {len(li_rp):>7} | {loop_time:>8.3f} {loop_peak / 2**20:>8.1f} '
+              f'| {acc_time:>8.3f} {acc_peak / 2**20:>8.1f}')
@@ -0,0 +1,83 @@
+"""
+Benchmark of merge_report: vectorized shipper names against list comprehensions over itertuples()
+
+report.csv is scaled to --rows rows spread over --shippers shippers, with Vietnamese shipper names
+(shipper_info) and one Drive folder per shipper (co_tong_folder):
+- itertuples: shipper_id, f_name and 'Tên đối tác' built row by row, unidecode called once per row, as before
+- merge_report: vectorized string operations, unidecode called once per distinct shipper name
+Both results are checked to be the same
+
+Run from the repo root: python bench/bench_merge_report.py [--rows 114000] [--shippers 600]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+import unidecode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from Retail_export import format_created_date, merge_report
+
+LI_NAME = ['Nguyễn Văn Đức', 'Trần Thị Hồng', 'Lê Hoàng Phúc', 'Phạm Minh Tuấn', 'Đỗ Thị Ngọc Ánh',
+           'Võ Quốc Bảo', 'Huỳnh Thanh Tùng', 'Bùi Thị Thu Hà', 'Đặng Hữu Nghĩa', 'Ngô Gia Khánh']
+
+
+def scaled_inputs(rows, shippers):
+    report = pd.read_csv(os.path.join(ROOT, 'report.csv'), index_col=0)
+    report = pd.concat([report] * (rows // len(report) + 1), ignore_index=True).iloc[:rows]
+    report['shipper_id'] = report.index % shippers
+    shipper_info = pd.DataFrame({'shipper_id': [str(k) for k in range(shippers)],
+                                 'shipper_name': [f'{LI_NAME[k % len(LI_NAME)]} {k}' for k in range(shippers)],
+                                 'shipper_name_rut_gon': [f' {LI_NAME[k % len(LI_NAME)]} {k} ' for k in range(shippers)],
+                                 'status': 'ongoing'})
+    co_tong_folder = pd.DataFrame({'f_id': [f'folder{k}' for k in range(shippers)],
+                                   'f_name': ['CO ' + unidecode.unidecode(name.strip()).upper()
+                                              for name in shipper_info['shipper_name_rut_gon']]})
+    return report, shipper_info, co_tong_folder
+
+
+def merge_report_itertuples(report, shipper_info, co_tong_folder):
+    report['shipper_id'] = [str(i.shipper_id) for i in report.itertuples()]
+    temp = report.merge(shipper_info, how='inner', on='shipper_id')
+    temp.drop_duplicates(inplace=True)
+
+    temp['f_name'] = [
+        "CO " + unidecode.unidecode(i.shipper_name_rut_gon.strip()).upper() for i in temp.itertuples()]
+    final = temp.merge(co_tong_folder, how='inner', on='f_name')
+
+    final['Ngày tạo đơn'] = format_created_date(final['Ngày tạo đơn'])
+    cur_date = datetime.today().strftime("%d-%m-%Y")
+    final['Tên đối tác'] = ["CO " + unidecode.unidecode(i.shipper_name_rut_gon.strip())
+                            + " " + cur_date for i in final.itertuples()]
+    final.rename(columns={'Instruction': 'Hướng dẫn giao hàng'}, inplace=True)
+    final['Kết quả'], final['Ghi chú'] = '', ''
+    return temp, final
+
+
+def measure(func, report, shipper_info, co_tong_folder):
+    # merge_report changes report in place, each run gets its own copy
+    report = report.copy()
+    start = time.perf_counter()
+    result = func(report, shipper_info, co_tong_folder)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=114000)
+    parser.add_argument('--shippers', type=int, default=600)
+    args = parser.parse_args()
+
+    inputs = scaled_inputs(args.rows, args.shippers)
+    print(f'{args.rows} rows, {args.shippers} shippers')
+    (old_temp, old_final), old_time = measure(merge_report_itertuples, *inputs)
+    (new_temp, new_final), new_time = measure(merge_report, *inputs)
+
+    pd.testing.assert_frame_equal(old_temp, new_temp)
+    pd.testing.assert_frame_equal(old_final, new_final)
+    print(f'itertuples:   {old_time:.3f} s')
+    print(f'merge_report: {new_time:.3f} s ({old_time / new_time:.1f}x)')
@@ -0,0 +1,63 @@
+"""
+Benchmark of splitting the report by shipper: ReportPartition against one boolean filter per shipper
+
+report.csv is scaled to --rows rows spread over --shippers shippers (f_name), then every shipper's report is read:
+- boolean filter: {i: final[final['f_name'] == i] for i in set(final['f_name'])}, one scan of the report per shipper, as before
+- ReportPartition: one groupby, each shipper's rows sliced by their indices
+Both results are checked to be the same; the boolean filter takes more than a minute at the default size
+
+Run from the repo root: python bench/bench_partition.py [--rows 200000] [--shippers 5000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from Retail_export import ReportPartition
+
+
+def scaled_report(rows, shippers):
+    report = pd.read_csv(os.path.join(ROOT, 'report.csv'), index_col=0)
+    report = pd.concat([report] * (rows // len(report) + 1), ignore_index=True).iloc[:rows]
+    report['f_name'] = [f'CO SHIPPER {k % shippers}' for k in range(rows)]
+    return report
+
+
+def boolean_filter(final):
+    return {i: final[final['f_name'] == i] for i in set(final['f_name'])}
+
+
+def partition(final):
+    report_dict = ReportPartition(final, 'f_name')
+    # slices are built on first use, read all of them as the upload does
+    for i in report_dict:
+        report_dict[i]
+    return report_dict
+
+
+def measure(func, report):
+    start = time.perf_counter()
+    result = func(report)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--shippers', type=int, default=5000)
+    args = parser.parse_args()
+
+    report = scaled_report(args.rows, args.shippers)
+    print(f'{len(report)} rows, {report["f_name"].nunique()} shippers')
+    old, old_time = measure(boolean_filter, report)
+    new, new_time = measure(partition, report)
+
+    assert set(old) == set(new)
+    for i in old:
+        pd.testing.assert_frame_equal(old[i], new[i])
+    print(f'boolean filter:  {old_time:.3f} s')
+    print(f'ReportPartition: {new_time:.3f} s ({old_time / new_time:.0f}x)')
@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of the latency of Redash requests: RedashClient (pooled keep-alive session)
+against one new connection per request
+
+A local HTTP stub answers the Redash API used by the tool: refresh, job status, query result.
+A run of --chunks chunks is replayed, each chunk sends 1 refresh, --polls job checks and 1 result request:
+- bare: requests.get/post for every request, so every request opens a new connection, as before
+- pooled: RedashClient, connections are kept alive and reused
+The stub waits --handshake-ms when a connection is opened, standing in for the TCP + TLS handshake
+with redash-vn (a plain local connection alone costs almost nothing)
+
+Run from the repo root: python bench/bench_redash_client.py [--chunks 30] [--polls 3] [--handshake-ms 30]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from Retail_export import RedashClient, redash_check_job, redash_refresh, redash_result
+
+ROWS = [{'Mã': f'T{i}', 'Số lần giao': 1} for i in range(1000)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent in separate writes, without this a kept-alive connection waits for delayed ACK
+    disable_nagle_algorithm = True
+    handshake = 0.0
+    connections = 0
+
+    def setup(self):
+        # called once per connection
+        StubHandler.connections += 1
+        time.sleep(self.handshake)
+        super().setup()
+
+    def send_json(self, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_json({'job': {'id': 'job'}})
+
+    def do_GET(self):
+        if self.path.startswith('/api/jobs/'):
+            self.send_json({'job': {'status': 3, 'query_result_id': 1}})
+        else:
+            columns = [{'name': 'Mã', 'type': 'string'}, {'name': 'Số lần giao', 'type': 'integer'}]
+            self.send_json({'query_result': {'data': {'columns': columns, 'rows': ROWS}}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BareClient:
+    """Same interface as RedashClient, one requests.get/post (new connection) per request"""
+    def __init__(self, api_key, url):
+        self.url = url
+        self.headers = {'Authorization': f'Key {api_key}'}
+
+    def get(self, endpoint):
+        return requests.get(f'{self.url}/api/{endpoint}', headers=self.headers)
+
+    def post(self, endpoint, data):
+        return requests.post(f'{self.url}/api/{endpoint}', data=data, headers=self.headers)
+
+    def close(self):
+        pass
+
+
+def run(client, chunks, polls):
+    n_request = 0
+    start = time.perf_counter()
+    for k in range(chunks):
+        job_id = redash_refresh(171, client, {'tracking_id': f"'T{k}'"})
+        for _ in range(polls):
+            _, result_id = redash_check_job(job_id, client)
+        redash_result(result_id, client)
+        n_request += polls + 2
+    return time.perf_counter() - start, n_request
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=30)
+    parser.add_argument('--polls', type=int, default=3)
+    parser.add_argument('--handshake-ms', type=float, default=30)
+    args = parser.parse_args()
+
+    StubHandler.handshake = args.handshake_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    print(f'{args.chunks} chunks x ({args.polls} checks + refresh + result), handshake {args.handshake_ms:g} ms')
+    print(f"{'client':>7} {'requests':>9} {'connections':>12} {'total s':>8} {'ms/request':>11}")
+    for name, client in [('bare', BareClient('key', url)), ('pooled', RedashClient('key', url=url))]:
+        StubHandler.connections = 0
+        elapsed, n_request = run(client, args.chunks, args.polls)
+        client.close()
+        print(f'{name:>7} {n_request:>9} {StubHandler.connections:>12} {elapsed:>8.3f} {elapsed / n_request * 1000:>11.2f}')
+    server.shutdown()
@@ -0,0 +1,62 @@
+"""
+Benchmark of removing illegal excel characters from the report:
+one sanitize_report pass against applymap on every shipper's slice
+
+report.csv is scaled to --rows rows and --dirty of the 'Instruction' cells get a control character
+which openpyxl cannot write (as some notes typed by shippers have):
+- applymap: ILLEGAL_CHARACTERS_RE.sub on every cell of every shipper's slice, as before
+- sanitize_report: one pass over the whole report, columns without illegal characters are skipped
+Both results are checked to be the same
+
+Run from the repo root: python bench/bench_sanitize.py [--rows 200000] [--dirty 0.01]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from Retail_export import ILLEGAL_CHARACTERS_RE, sanitize_report
+
+
+def scaled_report(rows, dirty):
+    report = pd.read_csv(os.path.join(ROOT, 'report.csv'), index_col=0)
+    report = pd.concat([report] * (rows // len(report) + 1), ignore_index=True).iloc[:rows]
+    rng = np.random.default_rng(0)
+    li_dirty = rng.random(len(report)) < dirty
+    report.loc[li_dirty, 'Instruction'] = report.loc[li_dirty, 'Instruction'].astype(str) + '\x0b\x1f'
+    return report
+
+
+def applymap_by_shipper(report):
+    li_slice = []
+    for _, temp in report.groupby('Tên đối tác', sort=False):
+        li_slice.append(temp.applymap(lambda x: ILLEGAL_CHARACTERS_RE.sub(r'', x) if isinstance(x, str) else x))
+    return pd.concat(li_slice).sort_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--dirty', type=float, default=0.01)
+    args = parser.parse_args()
+
+    report = scaled_report(args.rows, args.dirty)
+    print(f"{len(report)} rows, {report['Tên đối tác'].nunique()} shippers, "
+          f"{report['Instruction'].str.contains(ILLEGAL_CHARACTERS_RE, na=False).sum()} dirty cells")
+
+    start = time.perf_counter()
+    old = applymap_by_shipper(report.copy())
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = sanitize_report(report.copy())
+    new_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(old, new)
+    print(f'applymap by shipper: {old_time:.3f} s')
+    print(f'sanitize_report:     {new_time:.3f} s ({old_time / new_time:.0f}x)')
@@ -1,4 +1,7 @@
 import pandas as pd
+import time
+import random
+import threading
 from tenacity import *
 from datetime import datetime
 from openpyxl import Workbook
@@ -27,17 +30,161 @@ def connect_drive(bi_key, auth, drive, gspread):
     print("Connected to DRIVE!")
     return gc, drive
 
+# Google API quota: requests allowed per 100 seconds, shared by all threads
+DRIVE_QUOTA = 1000
+# Max requests sent at once after being idle
+API_BURST = 20
+# Retries of a request rejected by quota, waiting 1, 2, 4.. (max 64) seconds in between
+QUOTA_RETRIES = 8
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED', 'RESOURCE_EXHAUSTED')
+
+class TokenBucket:
+    """
+    Rate limiter shared by all threads
+    Tokens are added at quota/100 per second up to `capacity`; take() waits until a token is available
+    Counters:
+    - throttled: seconds spent waiting for a token
+    - backoff, retries: seconds spent backing off / number of retries after quota errors
+    """
+    def __init__(self, name, quota, capacity=API_BURST):
+        self.name = name
+        self.rate = quota / 100
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.backoff = 0
+        self.retries = 0
+
+    def take(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve n tokens, wait outside the lock until they are refilled
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+            if wait > 0:
+                self.throttled += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def add_backoff(self, seconds):
+        with self.lock:
+            self.backoff += seconds
+            self.retries += 1
+
+    def report(self):
+        print(f'{self.name} API: throttled {self.throttled:.1f}s, '
+              f'backoff {self.backoff:.1f}s after {self.retries} quota errors')
+
+drive_limiter = TokenBucket('Drive', DRIVE_QUOTA)
+
+def is_quota_error(e):
+    # PyDrive raises ApiRequestError(HttpError) - status in resp.status, reason in content
+    # gspread raises APIError - status in response.status_code, reason in its message
+    for err in (e, *e.args):
+        status = getattr(getattr(err, 'resp', None), 'status', None) or \
+            getattr(getattr(err, 'response', None), 'status_code', None)
+        if status is not None:
+            detail = str(err) + str(getattr(err, 'content', ''))
+            return int(status) == 429 or (int(status) == 403 and any(r in detail for r in QUOTA_REASONS))
+    return False
+
+def count_backoff(retry_state):
+    retry_state.args[0].add_backoff(retry_state.next_action.sleep)
+
+@retry(retry=retry_if_exception(is_quota_error), wait=wait_random_exponential(multiplier=1, max=64),
+       stop=stop_after_attempt(QUOTA_RETRIES), before_sleep=count_backoff, reraise=True)
+def google_call(limiter, func, *args, **kwargs):
+    """
+    Send one Drive/Sheets request within the quota:
+    - take a token from limiter before the request
+    - retry with exponential backoff when the request is rejected by quota (403 rateLimitExceeded / 429)
+
+    Input: limiter, function sending the request and its arguments
+
+    Output: result of func
+    """
+    limiter.take()
+    return func(*args, **kwargs)
+
+def drive_call(func, *args, **kwargs):
+    return google_call(drive_limiter, func, *args, **kwargs)
+
+# Max deletions sent in one batch request (Drive allows 100)
+DELETE_BATCH_SIZE = 100
+
+def is_retryable_error(e):
+    # quota errors and Drive server errors (500, 502, 503..) may succeed when sent again later
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    return is_quota_error(e) or (status is not None and int(status) >= 500)
+
+def batch_delete_files(drive, li_file_id):
+    """
+    Delete files with batch requests of DELETE_BATCH_SIZE deletions, instead of one request per file
+    - every deletion in a batch has its own result, only the failed ones are sent again
+      (with exponential backoff) when they were rejected by quota or a server error
+    - a file which was already deleted (404) counts as deleted
+    PyDrive builds a Drive v2 service, so v2 files.delete requests are batched
+
+    Input: drive, list of file id
+
+    Output: dictionary of {file id: exception} of files which could not be deleted
+    """
+    if drive.auth.service is None:
+        drive.auth.Authorize()
+    service = drive.auth.service
+
+    li_file_id = list(dict.fromkeys(li_file_id))
+    failed = {}
+    for attempt in range(QUOTA_RETRIES):
+        # result of files sent again replaces their previous error
+        for file_id in li_file_id:
+            failed.pop(file_id, None)
+
+        def callback(request_id, response, exception):
+            if exception is not None and getattr(getattr(exception, 'resp', None), 'status', None) != 404:
+                failed[request_id] = exception
+
+        for k in range(0, len(li_file_id), DELETE_BATCH_SIZE):
+            chunk = li_file_id[k:k + DELETE_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for file_id in chunk:
+                batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+            # every deletion in the batch counts against the quota
+            drive_limiter.take(len(chunk))
+            try:
+                # own http object, the one shared by PyDrive is not thread-safe
+                batch.execute(http=drive.auth.Get_Http_Object())
+            except Exception as e:
+                for file_id in chunk:
+                    failed.setdefault(file_id, e)
+
+        li_file_id = [file_id for file_id in li_file_id if file_id in failed and is_retryable_error(failed[file_id])]
+        if not li_file_id or attempt == QUOTA_RETRIES - 1:
+            break
+        wait = min(64, 2 ** attempt) * random.uniform(0.5, 1)
+        drive_limiter.add_backoff(wait)
+        time.sleep(wait)
+    return failed
+
 def get_li_files(drive, parents_id):
-    return drive.ListFile(
+    return drive_call(lambda: drive.ListFile(
         {'q' : f"'{parents_id}' in parents and trashed=false"}
-    ).GetList()
+    ).GetList())
 
 def del_file_drive(drive, parents_id):
     try:
-        li_files = drive.ListFile({'q': f"'{parents_id}' in parents and trashed=false"}).GetList()
+        li_files = get_li_files(drive, parents_id)
+        failed = batch_delete_files(drive, [file['id'] for file in li_files])
         for file in li_files:
-            file.Delete()
-            print(f'Deleted "{file["title"]}"')
+            if file['id'] in failed:
+                print(failed[file['id']])
+                print(f'Error when deleting "{file["title"]}"')
+            else:
+                print(f'Deleted "{file["title"]}"')
     except Exception as e:
         print(e)
         print("Error when deleting file")
@@ -61,6 +208,7 @@ gc, drive = connect_drive(bi_key,auth,drive,gspread)
 def main():
     parents_id = "1Auh1YD8esPeC7KtAtz2gQbBH9hcyuhgI"
     del_file_drive(drive, parents_id)
+    drive_limiter.report()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,116 @@
+import itertools
+import re
+import threading
+
+
+class FakeFile(dict):
+    """Metadata of a file as PyDrive's GoogleDriveFile, Upload() stores it in the drive"""
+    def __init__(self, drive, metadata):
+        super().__init__(metadata)
+        self.drive = drive
+        self.content = None
+
+    def Upload(self, param=None):
+        self.drive.upload(self)
+
+
+class FakeFileList:
+    """Pages of a files.list query on parents"""
+    def __init__(self, drive, param):
+        li_parents_id = set(re.findall(r"'([^']*)' in parents", param['q']))
+        with drive.lock:
+            self.pages = [[FakeFile(drive, {k: v for k, v in file.items() if k != 'content'})
+                           for file in drive.files.values()
+                           if any(parent['id'] in li_parents_id for parent in file['parents'])]]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pages:
+            raise StopIteration
+        return self.pages.pop(0)
+
+
+class FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.li_file_id = []
+
+    def add(self, file_id, request_id):
+        self.li_file_id.append(file_id)
+
+    def execute(self, http=None):
+        for file_id in self.li_file_id:
+            with self.drive.lock:
+                self.drive.files.pop(file_id, None)
+            self.callback(file_id, None, None)
+
+
+class FakeService:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return self
+
+    def delete(self, fileId):
+        return fileId
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self.drive, callback)
+
+
+class FakeAuth:
+    def __init__(self, drive):
+        self.service = FakeService(drive)
+
+    def Get_Http_Object(self):
+        return object()
+
+
+class FakeDrive:
+    """
+    Drive of PyDrive in memory: files by id, with their parents and content
+    - upload into a folder which does not exist fails, as Drive answers 404
+    - fail_titles: titles whose upload always fails
+    - uploads: (title, parent id) of every uploaded file, in order; folders: the same for created folders
+    """
+    def __init__(self, fail_titles=()):
+        self.files = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.fail_titles = set(fail_titles)
+        self.uploads = []
+        self.folders = []
+        self.auth = FakeAuth(self)
+
+    def CreateFile(self, metadata=None):
+        return FakeFile(self, dict(metadata or {}))
+
+    def ListFile(self, param):
+        return FakeFileList(self, param)
+
+    def add_folder(self, title, parents_id='root'):
+        folder = self.CreateFile({'title': title, 'parents': [{'id': parents_id}],
+                                  'mimeType': 'application/vnd.google-apps.folder'})
+        folder.Upload()
+        return folder['id']
+
+    def upload(self, file):
+        with self.lock:
+            parents_id = file['parents'][0]['id']
+            if parents_id != 'root' and parents_id not in self.files:
+                raise Exception(f'<HttpError 404 "File not found: {parents_id}">')
+            if file['title'] in self.fail_titles:
+                raise Exception('<HttpError 500 "Backend Error">')
+            file['id'] = f'id{next(self.ids)}'
+            self.files[file['id']] = dict(file, content=file.content.getvalue() if file.content is not None else None)
+            if file.get('mimeType') == 'application/vnd.google-apps.folder':
+                self.folders.append((file['title'], parents_id))
+            else:
+                self.uploads.append((file['title'], parents_id))
+
+    def children(self, parents_id):
+        return [file for file in self.files.values() if file['parents'][0]['id'] == parents_id]
@@ -0,0 +1,112 @@
+import json
+import re
+
+from gspread.utils import a1_to_rowcol
+
+
+class FakeWorksheet:
+    """Grid of string cells with the size limits of a Google Sheets worksheet"""
+    def __init__(self, spreadsheet, title, id, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = id
+        self.row_count = rows
+        self.col_count = cols
+        self.cells = {}
+
+    def write(self, row, col, values):
+        for i, li_value in enumerate(values):
+            for j, value in enumerate(li_value):
+                if row + i > self.row_count or col + j > self.col_count:
+                    raise ValueError(f'{self.title}: range exceeds grid limits')
+                # null in the json body leaves the cell empty
+                self.cells[(row + i, col + j)] = '' if value is None else value if isinstance(value, str) else str(value)
+
+    def values(self) -> list:
+        # rows of the sheet as the API returns them: trailing empty cells and rows are dropped
+        if not self.cells:
+            return []
+        n_row = max(r for r, c in self.cells)
+        n_col = max(c for r, c in self.cells)
+        rows = [[self.cells.get((r, c), '') for c in range(1, n_col + 1)] for r in range(1, n_row + 1)]
+        rows = [row[:max([i + 1 for i, value in enumerate(row) if value] or [0])] for row in rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def get_all_values(self):
+        self.spreadsheet.calls += 1
+        return self.values()
+
+    def add_rows(self, n):
+        self.spreadsheet.calls += 1
+        self.row_count += n
+
+    def add_cols(self, n):
+        self.spreadsheet.calls += 1
+        self.col_count += n
+
+
+class FakeSpreadsheet:
+    """Spreadsheet answering the batch requests used by the tools, counting requests in `calls`"""
+    def __init__(self, titles, id='spreadsheet'):
+        self.id = id
+        self.calls = 0
+        self.requests = []
+        self.ws = {title: FakeWorksheet(self, title, i) for i, title in enumerate(titles)}
+
+    def worksheets(self):
+        self.calls += 1
+        return list(self.ws.values())
+
+    def get_worksheet(self, index):
+        self.calls += 1
+        return list(self.ws.values())[index]
+
+    def parse(self, range_name):
+        match = re.match(r"'(.+)'(?:!([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?)?$", range_name)
+        return self.ws[match.group(1)], match
+
+    def values_batch_get(self, ranges, params=None):
+        self.calls += 1
+        li_value_range = []
+        for range_name in ranges:
+            ws, match = self.parse(range_name)
+            col = a1_to_rowcol(match.group(2) + '1')[1]
+            if match.group(3):
+                value = ws.cells.get((int(match.group(3)), col))
+                li_value_range.append({'values': [[value]]} if value else {})
+            else:
+                values = [[row[col - 1]] if len(row) >= col and row[col - 1] else [] for row in ws.values()]
+                while values and not values[-1]:
+                    values.pop()
+                li_value_range.append({'values': values} if values else {})
+        return {'valueRanges': li_value_range}
+
+    def values_batch_clear(self, params=None, body=None):
+        self.calls += 1
+        self.requests.append(('clear', body))
+        for range_name in body['ranges']:
+            self.parse(range_name)[0].cells = {}
+
+    def values_batch_update(self, params=None, body=None):
+        # values:batchUpdate takes valueInputOption in the body, gspread sends params in the query string
+        assert 'valueInputOption' in body and 'valueInputOption' not in (params or {})
+        # requests sends the body as json, NaN is rejected
+        json.dumps(body, allow_nan=False)
+        self.calls += 1
+        self.requests.append(('update', body))
+        for value_range in body['data']:
+            ws, match = self.parse(value_range['range'])
+            row, col = a1_to_rowcol(match.group(2) + match.group(3))
+            ws.write(row, col, value_range['values'])
+
+    def batch_update(self, body):
+        self.calls += 1
+        for request in body['requests']:
+            append = request['appendDimension']
+            ws = [ws for ws in self.ws.values() if ws.id == append['sheetId']][0]
+            if append['dimension'] == 'ROWS':
+                ws.row_count += append['length']
+            else:
+                ws.col_count += append['length']
@@ -0,0 +1,95 @@
+import pytest
+
+
+@pytest.fixture(params=['Retail_collect', 'FS_collect'])
+def tool(request):
+    return pytest.importorskip(request.param)
+
+
+class FakeRequest:
+    def __init__(self, auth, response):
+        self.auth = auth
+        self.response = response
+
+    def execute(self, http=None):
+        assert http is not None and http is not self.auth.service_http
+        return self.response
+
+
+class FakeChanges:
+    """changes resource of Drive v2 over a recorded feed: {page token: page}"""
+    def __init__(self, auth, pages, start_token):
+        self.auth = auth
+        self.pages = pages
+        self.start_token = start_token
+
+    def getStartPageToken(self):
+        return FakeRequest(self.auth, {'startPageToken': self.start_token})
+
+    def list(self, pageToken, fields, maxResults):
+        return FakeRequest(self.auth, self.pages[pageToken])
+
+
+class FakeService:
+    def __init__(self, auth):
+        self.auth = auth
+
+    def changes(self):
+        return FakeChanges(self.auth, self.auth.pages, self.auth.start_token)
+
+
+class FakeAuth:
+    """PyDrive GoogleAuth before anything was sent: credentials are set, service is not built yet"""
+    def __init__(self, pages, start_token):
+        self.pages = pages
+        self.start_token = start_token
+        self.service = None
+        self.service_http = object()
+        self.authorized = 0
+
+    def Authorize(self):
+        self.authorized += 1
+        self.service = FakeService(self)
+
+    def Get_Http_Object(self):
+        return object()
+
+
+class FakeDrive:
+    def __init__(self, pages, start_token='100'):
+        self.auth = FakeAuth(pages, start_token)
+
+
+PAGES = {
+    '100': {'items': [{'fileId': 'a'}], 'nextPageToken': '101'},
+    '101': {'items': [{'fileId': 'b'}], 'newStartPageToken': '102'},
+    '102': {'items': [], 'newStartPageToken': '102'},
+}
+
+
+def test_start_authorizes_drive(tool, tmp_path):
+    drive = FakeDrive(PAGES)
+    changes = tool.DriveChanges(drive, str(tmp_path / 'token.json'), '01-01-2023')
+    changes.start()
+    assert drive.auth.authorized == 1
+    assert changes.page_token == '100'
+    assert [change['fileId'] for change in changes.poll()] == ['a', 'b']
+
+
+def test_page_token_is_saved_after_poll(tool, tmp_path):
+    file_name = str(tmp_path / 'token.json')
+    changes = tool.DriveChanges(FakeDrive(PAGES), file_name, '01-01-2023')
+    changes.start()
+    changes.poll()
+    changes.save()
+
+    # a restarted watcher continues after the saved changes
+    restarted = tool.DriveChanges(FakeDrive(PAGES), file_name, '01-01-2023')
+    restarted.start()
+    assert restarted.page_token == '102'
+    assert restarted.poll() == []
+
+    # token of another day is not used
+    next_day = tool.DriveChanges(FakeDrive(PAGES, start_token='101'), file_name, '02-01-2023')
+    next_day.start()
+    assert next_day.page_token == '101'
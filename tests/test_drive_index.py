@@ -0,0 +1,106 @@
+import re
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture(params=['Retail_export', 'FS_export', 'Retail_collect', 'FS_collect'])
+def tool(request):
+    return pytest.importorskip(request.param)
+
+
+class FakeFileList:
+    """Pages of a files.list query, the first page fails if the query contains a bad folder id"""
+    def __init__(self, pages, error):
+        self.pages = pages
+        self.error = error
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.error is not None:
+            raise self.error
+        if not self.pages:
+            raise StopIteration
+        return self.pages.pop(0)
+
+
+class FakeDrive:
+    def __init__(self, folders, bad=(), flaky=False):
+        self.folders = folders
+        self.bad = set(bad)
+        # flaky: every query of more than one folder fails, as a page answered by a 500
+        self.flaky = flaky
+        self.queries = []
+
+    def ListFile(self, param):
+        li_parents_id = re.findall(r"'([^']*)' in parents", param['q'])
+        self.queries.append(li_parents_id)
+        error = None
+        if self.bad.intersection(li_parents_id):
+            error = Exception('<HttpError 404 "File not found">')
+        elif self.flaky and len(li_parents_id) > 1:
+            error = Exception('<HttpError 500 "Internal Error">')
+        files = [file for i in li_parents_id for file in self.folders.get(i, [])]
+        return FakeFileList([files[k:k + 2] for k in range(0, len(files), 2)], error)
+
+
+def file(folder_id, title):
+    return {'id': f'{folder_id}/{title}', 'title': title, 'parents': [{'id': folder_id}]}
+
+
+FOLDERS = {f'f{i}': [file(f'f{i}', f'CO_{i}_01-01-2023.xlsx'), file(f'f{i}', f'CO_{i}_02-01-2023.xlsx')]
+           for i in range(5)}
+
+
+def test_load_lists_folders_in_bulk(tool):
+    drive = FakeDrive(FOLDERS)
+    index = tool.DriveIndex(drive)
+    index.load(list(FOLDERS))
+    assert drive.queries == [list(FOLDERS)]
+    assert [f['title'] for f in index.get('f3')] == ['CO_3_01-01-2023.xlsx', 'CO_3_02-01-2023.xlsx']
+    # get() of a loaded folder does not query again
+    assert len(drive.queries) == 1
+
+
+def test_bad_folder_does_not_stop_load(tool, monkeypatch, capsys):
+    monkeypatch.setattr(tool, 'INDEX_PARENTS_PER_QUERY', 3)
+    drive = FakeDrive(FOLDERS, bad=['-'])
+    index = tool.DriveIndex(drive)
+    index.load(['f0', '-', 'f1', 'f2', 'f3', 'f4'])
+
+    # the failed chunk is listed again one folder at a time, the next chunk is sent as usual
+    assert drive.queries == [['f0', '-', 'f1'], ['f0'], ['-'], ['f1'], ['f2', 'f3', 'f4']]
+    assert all(len(index.get(i)) == 2 for i in FOLDERS)
+    assert 'Error when listing folder -' in capsys.readouterr().out
+    with pytest.raises(Exception):
+        index.get('-')
+
+
+def test_failed_page_falls_back_to_one_folder_per_query(tool):
+    drive = FakeDrive(FOLDERS, flaky=True)
+    index = tool.DriveIndex(drive)
+    index.load(list(FOLDERS))
+    assert drive.queries == [list(FOLDERS)] + [[i] for i in FOLDERS]
+    assert all(len(index.get(i)) == 2 for i in FOLDERS)
+
+
+def test_collect_skips_folder_which_cannot_be_listed(monkeypatch, capsys):
+    tool = pytest.importorskip('Retail_collect')
+    cur_date = datetime.today().strftime("%d-%m-%Y")
+    folders = {'f0': [file('f0', f'CO_0_{cur_date}.xlsx')], 'f1': [file('f1', f'CO_1_{cur_date}.xlsx')]}
+    monkeypatch.setattr(tool, 'fetch_responses', lambda drive, files, cache: dict(files))
+
+    responses, files = tool.collect_folder_responses(FakeDrive(folders, bad=['']), ['f0', '', 'f1'], None)
+
+    assert list(files) == ['f0', 'f1']
+    assert 'Không tìm thấy file trong folder ' in capsys.readouterr().out
+
+
+def test_delete_in_folder_which_cannot_be_listed(capsys):
+    tool = pytest.importorskip('Retail_export')
+    index = tool.DriveIndex(FakeDrive(FOLDERS, bad=['-']))
+    index.load(['f0', '-'])
+    tool.del_file_drive(None, '-', index)
+    assert 'Error when deleting file' in capsys.readouterr().out
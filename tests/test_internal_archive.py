@@ -0,0 +1,124 @@
+import zipfile
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+
+
+@pytest.fixture(params=['Retail_export', 'FS_export'])
+def tool(request):
+    return pytest.importorskip(request.param)
+
+
+class FakeUploadRequest:
+    """Resumable upload reading the media as googleapiclient does, optionally failing after some parts"""
+    def __init__(self, media, uploaded, fail_after):
+        self.media = media
+        self.uploaded = uploaded
+        self.fail_after = fail_after
+        self.resumable_progress = 0
+
+    def next_chunk(self, http=None, num_retries=0):
+        if self.fail_after is not None and self.resumable_progress >= self.fail_after:
+            raise Exception('<HttpError 500 "Backend Error">')
+        data = self.media.getbytes(self.resumable_progress, self.media.chunksize())
+        self.uploaded += data
+        self.resumable_progress += len(data)
+        size = self.media.size()
+        if size is not None and self.resumable_progress >= size:
+            return None, {'id': 'new_zip'}
+        return None, None
+
+
+class FakeFiles:
+    def __init__(self, auth):
+        self.auth = auth
+
+    def insert(self, body, media_body):
+        self.auth.inserted.append(body)
+        return FakeUploadRequest(media_body, self.auth.uploaded, self.auth.fail_after)
+
+
+class FakeService:
+    def __init__(self, auth):
+        self.auth = auth
+
+    def files(self):
+        return FakeFiles(self.auth)
+
+
+class FakeAuth:
+    def __init__(self, fail_after):
+        self.service = None
+        self.fail_after = fail_after
+        self.inserted = []
+        self.uploaded = bytearray()
+
+    def Authorize(self):
+        self.service = FakeService(self)
+
+    def Get_Http_Object(self):
+        return object()
+
+
+class FakeDrive:
+    def __init__(self, fail_after=None):
+        self.auth = FakeAuth(fail_after)
+
+
+class FakeIndex:
+    """Internal folder holding today's folder with the zips uploaded by earlier runs"""
+    def __init__(self, li_zip_title=()):
+        find_date = datetime.today().strftime("%Y-%m-%d")
+        self.children = {'internal': [{'id': 'today', 'title': f'CO TONG {find_date}'}],
+                         'today': [{'id': f'old_zip{k}', 'title': title} for k, title in enumerate(li_zip_title)]}
+
+    def get(self, parents_id):
+        return self.children[parents_id]
+
+
+def open_archive(tool, monkeypatch, drive, li_zip_title=()):
+    deleted = []
+    monkeypatch.setattr(tool, 'del_file_zip_drive', lambda drive, li_del_files: deleted.extend(li_del_files))
+    archive = tool.open_internal_archive(drive, 'internal', FakeIndex(li_zip_title))
+    return archive, deleted
+
+
+def uploaded_title(tool, monkeypatch):
+    # title of the zip uploaded by a run with no earlier zip
+    drive = FakeDrive()
+    archive, deleted = open_archive(tool, monkeypatch, drive)
+    archive.close()
+    assert deleted == []
+    return drive.auth.inserted[0]['title']
+
+
+def test_old_zip_is_deleted_after_new_zip_is_uploaded(tool, monkeypatch):
+    title = uploaded_title(tool, monkeypatch)
+    assert title == datetime.today().strftime("%d-%m-%Y") + '.zip'
+
+    # rerun: the zip uploaded by the first run is found and replaced
+    drive = FakeDrive()
+    archive, deleted = open_archive(tool, monkeypatch, drive, [title])
+    # nothing is deleted before the new zip is in Drive
+    assert deleted == []
+    for i in range(3):
+        archive.add(f'CO_{i}', bytes([i]) * 200 * 1024)
+    archive.close()
+
+    assert [file['id'] for file in deleted] == ['old_zip0']
+    assert drive.auth.inserted[0]['parents'] == [{'id': 'today'}]
+    assert drive.auth.inserted[0]['title'] == title
+    with zipfile.ZipFile(BytesIO(bytes(drive.auth.uploaded))) as zf:
+        assert zf.namelist() == ['CO_0.xlsx', 'CO_1.xlsx', 'CO_2.xlsx']
+        assert zf.read('CO_2.xlsx') == bytes([2]) * 200 * 1024
+
+
+def test_old_zip_is_kept_when_upload_fails(tool, monkeypatch):
+    title = uploaded_title(tool, monkeypatch)
+    archive, deleted = open_archive(tool, monkeypatch, FakeDrive(fail_after=0), [title])
+    for i in range(3):
+        archive.add(f'CO_{i}', bytes([i]) * 200 * 1024)
+    with pytest.raises(Exception, match='Backend Error'):
+        archive.close()
+    assert deleted == []
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from fake_sheets import FakeSpreadsheet
+
+OUTPUT_SHEETS = ['result', 'done_export', 'no_shipper_info', 'new_shipper', 'error_export']
+DONE_EXPORT_COLUMNS = ['Lý do', 'Mã', 'Ngày tạo đơn', 'Số lần giao', 'Hướng dẫn giao hàng',
+                       'Tên khách hàng', 'shipper_id', 'Tên đối tác', 'Địa chỉ',
+                       'Số điện thoại', 'shipper_name', 'shipper_name_rut_gon', 'status',
+                       'f_name', 'f_id']
+
+
+@pytest.fixture(params=['Retail_export', 'FS_export'])
+def tool(request):
+    return pytest.importorskip(request.param)
+
+
+def output_args(spreadsheet, error_export):
+    done_export = pd.DataFrame([[f'r{i}', f'M{i}', '2023-01-01', 1, None, 'kh', i % 3, f'CO_{i % 3}', 'dc',
+                                 '090', 'sn', 'snr', 'Pending', 'folder', 'fid'] for i in range(6)],
+                               columns=DONE_EXPORT_COLUMNS)
+    report = pd.DataFrame({'shipper_id': [0, 1, 9], 'Mã': ['M0', 'M1', 'M9']})
+    shipper_info = pd.DataFrame({'shipper_id': [0, 1], 'shipper_name': ['a', 'b']})
+    return spreadsheet, ['9'], ['CO_9'], ['link'], done_export, report, shipper_info, error_export
+
+
+def test_output_with_empty_error_export(tool):
+    spreadsheet = FakeSpreadsheet(OUTPUT_SHEETS)
+    # stale rows of a previous run
+    spreadsheet.ws['error_export'].write(1, 1, [['Mã'], ['OLD']])
+    spreadsheet.ws['result'].write(2, 2, [[datetime.today().strftime("%d-%m-%Y 00:00:00")]])
+
+    tool.output(*output_args(spreadsheet, tool.FrameAccumulator().concat()))
+
+    ws = spreadsheet.ws
+    assert ws['error_export'].values() == []
+    assert ws['done_export'].values()[0] == DONE_EXPORT_COLUMNS
+    assert len(ws['done_export'].values()) == 7
+    assert ws['new_shipper'].values() == [['shipper_id', 'folder_name', 'folder_link'], ['9', 'CO_9', 'link']]
+    assert ws['result'].values()[4] == ['6', '3', '1', '1']
+    assert ws['result'].values()[1][1][:10] == datetime.today().strftime("%d-%m-%Y")
+
+
+def test_output_writes_error_export(tool):
+    spreadsheet = FakeSpreadsheet(OUTPUT_SHEETS)
+    spreadsheet.ws['result'].write(2, 2, [['01-01-2000 00:00:00']])
+    error_export = pd.DataFrame({'Mã': ['E1', 'E2'], 'Tên đối tác': ['CO_1', 'CO_2']})
+
+    tool.output(*output_args(spreadsheet, error_export))
+
+    assert spreadsheet.ws['error_export'].values() == [['Mã', 'Tên đối tác'], ['E1', 'CO_1'], ['E2', 'CO_2']]
+
+
+def test_sheet_writer_ignores_rows_without_cells(tool):
+    spreadsheet = FakeSpreadsheet(['a'])
+    writer = tool.SheetWriter(spreadsheet)
+    writer.update('a', [])
+    writer.update('a', [[]])
+    writer.update('a', [[], []])
+    writer.flush()
+    assert [kind for kind, body in spreadsheet.requests] == []
+
+
+def test_output_writes_missing_values_of_decoded_columns(tool):
+    spreadsheet = FakeSpreadsheet(OUTPUT_SHEETS)
+    spreadsheet.ws['result'].write(2, 2, [['01-01-2000 00:00:00']])
+    args = list(output_args(spreadsheet, None))
+    # report as redash_decode gives it: category and datetime columns with missing values
+    args[5] = pd.DataFrame({'shipper_id': [0, 9, 9], 'Mã': ['M0', 'M9', 'M10'],
+                            'Lý do': pd.Categorical(['a', None, 'b']),
+                            'Ngày tạo đơn': pd.to_datetime(['2023-01-01T08:00:00', None, '2023-01-02T09:30:00'])})
+    args[7] = pd.DataFrame({'Mã': ['E1', 'E2'], 'Tên đối tác': pd.Categorical(['CO_1', None]),
+                            'Ngày tạo đơn': pd.to_datetime([None, '2023-01-01T08:00:00'])})
+
+    tool.output(*args)
+
+    ws = spreadsheet.ws
+    assert ws['no_shipper_info'].values() == [['shipper_id', 'Mã', 'Lý do', 'Ngày tạo đơn', 'shipper_name'],
+                                              ['9', 'M9'],
+                                              ['9', 'M10', 'b', '2023-01-02T09:30:00']]
+    assert ws['error_export'].values() == [['Mã', 'Tên đối tác', 'Ngày tạo đơn'],
+                                           ['E1', 'CO_1'], ['E2', '', '2023-01-01T08:00:00']]
+
+
+def test_sheet_rows_sends_missing_cells_as_empty(tool):
+    df = pd.DataFrame({'n': [1, None], 'c': pd.Categorical(['x', None]), 'd': pd.to_datetime(['2023-01-01', None])})
+    assert tool.sheet_rows(df) == [['n', 'c', 'd'], [1.0, 'x', '2023-01-01T00:00:00'], [None, None, None]]
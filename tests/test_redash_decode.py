@@ -0,0 +1,43 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+
+@pytest.fixture(params=['Retail_export', 'FS_export'])
+def tool(request):
+    return pytest.importorskip(request.param)
+
+
+def payload(rows):
+    columns = [{'name': 'Mã', 'type': 'string'}, {'name': 'Tên đối tác', 'type': 'string'},
+               {'name': 'Số lần giao', 'type': 'integer'}, {'name': 'shipper_id', 'type': 'integer'},
+               {'name': 'Ngày tạo đơn', 'type': 'datetime'}]
+    return {'query_result': {'data': {'columns': columns, 'rows': rows}}}
+
+
+ROWS = [{'Mã': 'M1', 'Tên đối tác': 'CO_1', 'Số lần giao': 1, 'shipper_id': 7, 'Ngày tạo đơn': '2023-01-01T08:00:00'},
+        {'Mã': 'M2', 'Tên đối tác': 'CO_1', 'Số lần giao': None, 'shipper_id': 7, 'Ngày tạo đơn': '2023-01-02T08:00:00'}]
+
+
+def test_integer_columns_match_pandas_json_dtypes(tool):
+    df = tool.redash_decode(payload(ROWS))
+    expected = pd.DataFrame(ROWS)
+    assert df['shipper_id'].dtype == np.int64
+    assert df['Số lần giao'].dtype == expected['Số lần giao'].dtype == np.float64
+    assert df['Số lần giao'].isna().tolist() == [False, True]
+
+
+def test_integer_column_with_null_is_written(tool):
+    df = tool.redash_decode(payload(ROWS))
+
+    # output() fills missing cells before writing them to sheets
+    assert df.fillna('-')['Số lần giao'].tolist() == [1, '-']
+
+    name, content = tool.add_data_to_sheet(df)
+    assert name == 'CO_1'
+    rows = list(load_workbook(BytesIO(content)).active.values)
+    assert rows[1][:3] == ('M1', 'CO_1', 1)
+    assert rows[2][2] is None
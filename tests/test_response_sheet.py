@@ -0,0 +1,142 @@
+import pandas as pd
+import pytest
+
+from fake_sheets import FakeSpreadsheet
+
+HEADER = ['Mã', 'Lý do']
+
+
+@pytest.fixture(params=['Retail_collect', 'FS_collect'])
+def tool(request):
+    return pytest.importorskip(request.param)
+
+
+def test_upsert_updates_in_place_and_appends(tool):
+    old = [HEADER, ['A', '1'], ['B', '2'], ['C', '3']]
+    new = [HEADER + ['Ghi chú'], ['C', '30', 'x'], ['D', '4', 'y'], ['A', '1', 'z']]
+    assert tool.upsert_rows(old, new) == [
+        HEADER + ['Ghi chú'], ['A', '1', 'z'], ['B', '2', ''], ['C', '30', 'x'], ['D', '4', 'y']]
+
+
+def test_upsert_matches_repeated_keys_in_order(tool):
+    old = [HEADER, ['A', '1'], ['A', '2']]
+    new = [HEADER, ['A', '10'], ['A', '20'], ['A', '30']]
+    assert tool.upsert_rows(old, new) == [HEADER, ['A', '10'], ['A', '20'], ['A', '30']]
+
+
+def test_upsert_deletes_gone_rows_of_removed_keys_only(tool):
+    old = [HEADER, ['A', '1'], ['B', '2'], ['B', '3'], ['C', '4']]
+    new = [HEADER, ['B', '20']]
+    # B is kept once (still in new rows), A is deleted, C is not a removed key so it is kept
+    assert tool.upsert_rows(old, new, removed_keys={'A', 'B'}) == [HEADER, ['B', '20'], ['C', '4']]
+
+
+def test_update_sends_only_changed_rows_in_chunks(tool, monkeypatch):
+    monkeypatch.setattr(tool, 'SHEETS_BATCH_CELLS', 10)
+    spreadsheet = FakeSpreadsheet(['Sheet1'])
+    ws = spreadsheet.ws['Sheet1']
+    rows = [HEADER] + [[f'M{i}', 'ok'] for i in range(20)]
+    sheet = tool.ResponseSheet(ws, [])
+    assert sheet.update(rows) == 21
+    assert ws.values() == rows
+    assert all(sum(len(r['values']) * 2 for r in body['data']) <= 10 for kind, body in spreadsheet.requests)
+
+    spreadsheet.requests.clear()
+    changed = [list(row) for row in rows]
+    changed[5][1] = 'EDITED'
+    assert sheet.update(changed[:-2]) == 3
+    assert ws.values() == changed[:-2]
+
+
+class StubChanges:
+    """Replays one poll per callable of feed, then stops the watcher; snapshots the sheet on each save"""
+    def __init__(self, feed, ws):
+        self.feed = feed
+        self.ws = ws
+        self.snapshots = []
+
+    def start(self):
+        pass
+
+    def poll(self):
+        if not self.feed:
+            raise KeyboardInterrupt
+        return self.feed.pop(0)()
+
+    def save(self):
+        self.snapshots.append(self.ws.values())
+
+
+def response(folder_id, n, edit=None):
+    df = pd.DataFrame({'Mã': [f'{folder_id}_{i}' for i in range(n)], 'Lý do': ['ok'] * n})
+    if edit is not None:
+        df.loc[edit, 'Lý do'] = 'EDITED'
+    return df
+
+
+def test_watch_upserts_changes_and_deletes_removed_rows(tool, monkeypatch):
+    cur_date = tool.datetime.today().strftime("%d-%m-%Y")
+    done_export = pd.DataFrame({'f_id': ['f1', 'f2', 'f3']})
+    files = {f: {'id': f'file_{f}', 'title': f'CO_{f}_{cur_date}.xlsx'} for f in ['f1', 'f2', 'f3']}
+    versions = {'f1': response('f1', 3), 'f2': response('f2', 4), 'f3': response('f3', 2)}
+
+    monkeypatch.setattr(tool, 'collect_folder_responses',
+                        lambda drive, li_folder_id, cache: (dict(versions), dict(files)))
+    monkeypatch.setattr(tool, 'fetch_responses',
+                        lambda drive, changed, cache: {f: versions[f] for f in changed})
+    monkeypatch.setattr(tool, 'find_today_sheet', lambda drive, parents_id, hco_filename: None)
+    spreadsheet = FakeSpreadsheet(['Sheet1'])
+
+    class FakeGC:
+        def create(self, title, folder_id=None):
+            return spreadsheet
+
+    def change(folder_id, **kw):
+        def apply():
+            versions[folder_id] = response(folder_id, **kw)
+            return [{'fileId': files[folder_id]['id'], 'deleted': False,
+                     'file': dict(files[folder_id], parents=[{'id': folder_id}])}]
+        return apply
+
+    def trash(folder_id):
+        return lambda: [{'fileId': files[folder_id]['id'], 'deleted': True}]
+
+    feed = [change('f1', n=3, edit=1), change('f2', n=2), trash('f3')]
+    changes = StubChanges(feed, spreadsheet.ws['Sheet1'])
+    tool.watch_responses(FakeGC(), None, done_export, None, 'res', changes, interval=0)
+
+    polls = changes.snapshots
+    keys = [[row[0] for row in rows[1:]] for rows in polls]
+    assert polls[0][2] == ['f1_1', 'EDITED']
+    # rows deleted by shipper f2 are deleted from the sheet
+    assert keys[1] == ['f1_0', 'f1_1', 'f1_2', 'f2_0', 'f2_1', 'f3_0', 'f3_1']
+    # all rows of the trashed file are deleted
+    assert keys[2] == ['f1_0', 'f1_1', 'f1_2', 'f2_0', 'f2_1']
+
+
+def test_upsert_without_responses_keeps_the_sheet(tool):
+    old = [HEADER, ['A', '1'], ['B', '2'], ['C', '3']]
+    for new in ([], [[]], [HEADER]):
+        assert tool.upsert_rows(old, new) == old
+    # rows of removed keys are still deleted
+    assert tool.upsert_rows(old, [[]], removed_keys={'B'}) == [HEADER, ['A', '1'], ['C', '3']]
+    assert tool.upsert_rows([], [[]]) == []
+
+
+def test_export_without_responses_keeps_the_sheet(tool, monkeypatch):
+    spreadsheet = FakeSpreadsheet(['Sheet1'])
+    ws = spreadsheet.ws['Sheet1']
+    rows = [HEADER, ['A', '1'], ['B', '2'], ['C', '3']]
+    ws.write(1, 1, rows)
+    monkeypatch.setattr(tool, 'find_today_sheet', lambda drive, parents_id, hco_filename: {'id': 'today'})
+
+    class FakeGC:
+        def open_by_key(self, key):
+            return spreadsheet
+
+    # every download failed: responses is an empty frame
+    sheet = tool.export_responses(FakeGC(), None, pd.DataFrame(), 'res')
+
+    assert ws.values() == rows
+    assert spreadsheet.requests == []
+    assert sheet.rows == rows
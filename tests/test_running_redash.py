@@ -0,0 +1,152 @@
+import json
+import re
+import threading
+import time
+
+import pandas as pd
+import pytest
+from tenacity import wait_none
+
+
+@pytest.fixture(params=['Retail_export', 'FS_export'])
+def tool(request, monkeypatch):
+    tool = pytest.importorskip(request.param)
+    monkeypatch.setattr(tool, 'REDASH_CHUNK_SIZE', 3)
+    monkeypatch.setattr(tool, 'REDASH_POLL_MIN', 0.001)
+    monkeypatch.setattr(tool, 'REDASH_POLL_MAX', 0.005)
+    monkeypatch.setattr(tool.redash_query.retry, 'wait', wait_none())
+    return tool
+
+
+class FakeResponse:
+    def __init__(self, body, ok=True):
+        self.ok = ok
+        self.content = json.dumps(body).encode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeRedash:
+    """
+    Redash API of one query over a table of orders, in place of RedashClient
+    - each job finishes after `polls` status checks, the last jobs sent finish first
+    - fail_jobs / fail_results: chunks (by their first tracking id) whose job fails / whose result
+      cannot be fetched, the first time only
+    """
+    def __init__(self, fail_jobs=(), fail_results=()):
+        self.fail_jobs = set(fail_jobs)
+        self.fail_results = set(fail_results)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def post(self, endpoint, data):
+        assert endpoint == 'queries/171/results'
+        params = json.loads(data.decode('utf-8'))['parameters']
+        li_tracking_id = re.findall(r"'([^']*)'", params['tracking_id'])
+        with self.lock:
+            job_id = f'job{len(self.jobs)}'
+            self.jobs[job_id] = {'ids': li_tracking_id, 'polls': 0}
+            self.sent.append(li_tracking_id)
+            # earlier jobs wait longer, so results arrive in reverse order
+            self.jobs[job_id]['finish'] = 10 - len(self.jobs) % 10
+        return FakeResponse({'job': {'id': job_id}})
+
+    def get(self, endpoint):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # latency of the server, requests sent by the pool overlap
+        time.sleep(0.005)
+        try:
+            kind, key = endpoint.split('/', 1)
+            if kind == 'jobs':
+                return self.check(key)
+            return self.result(key)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def check(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['polls'] += 1
+            if job['ids'][0] in self.fail_jobs:
+                self.fail_jobs.discard(job['ids'][0])
+                return FakeResponse({'job': {'status': 4}})
+            if job['polls'] < job['finish']:
+                return FakeResponse({'job': {'status': 2 if job['polls'] > 1 else 1}})
+            return FakeResponse({'job': {'status': 3, 'query_result_id': job_id}})
+
+    def result(self, job_id):
+        with self.lock:
+            li_tracking_id = self.jobs[job_id]['ids']
+            if li_tracking_id[0] in self.fail_results:
+                self.fail_results.discard(li_tracking_id[0])
+                return FakeResponse({}, ok=False)
+        columns = [{'name': 'Mã', 'type': 'string'}, {'name': 'Số lần giao', 'type': 'integer'}]
+        rows = [{'Mã': i, 'Số lần giao': int(i[1:])} for i in li_tracking_id]
+        return FakeResponse({'query_result': {'data': {'columns': columns, 'rows': rows}}})
+
+
+LI_TRACKING_ID = pd.DataFrame({'tracking_id': [f'T{i}' for i in range(14)]})
+
+
+def expected():
+    return pd.DataFrame({'Mã': LI_TRACKING_ID.tracking_id, 'Số lần giao': range(14)})
+
+
+def test_concurrent_results_keep_chunk_order(tool):
+    client = FakeRedash()
+    report = tool.running_redash(LI_TRACKING_ID, 171, client, max_in_flight=4)
+    pd.testing.assert_frame_equal(report, expected())
+    assert len(client.sent) == 5
+    assert client.max_in_flight > 1
+
+
+def test_failed_chunks_are_run_again(tool):
+    client = FakeRedash(fail_jobs=['T3'], fail_results=['T9'])
+    report = tool.running_redash(LI_TRACKING_ID, 171, client, max_in_flight=4)
+    pd.testing.assert_frame_equal(report, expected())
+    # each failed chunk is sent once more, on its own
+    assert len(client.sent) == 7
+    assert sorted(ids[0] for ids in client.sent[5:]) == ['T3', 'T9']
+
+
+def test_sequential_run_gives_the_same_result(tool):
+    report = tool.running_redash(LI_TRACKING_ID, 171, FakeRedash(fail_jobs=['T6']), max_in_flight=1)
+    pd.testing.assert_frame_equal(report, expected())
+
+
+def test_cached_chunks_are_not_queried_again(tool, tmp_path):
+    file_name = str(tmp_path / 'cache.sqlite')
+    cache = tool.RedashCache(file_name)
+    first = FakeRedash(fail_results=['T0'])
+    tool.running_redash(LI_TRACKING_ID, 171, first, max_in_flight=4, cache=cache)
+    cache.close()
+
+    # rerun: every chunk, including the one re-run, comes from the cache
+    cache = tool.RedashCache(file_name)
+    rerun = FakeRedash()
+    report = tool.running_redash(LI_TRACKING_ID, 171, rerun, max_in_flight=4, cache=cache)
+    pd.testing.assert_frame_equal(report, expected())
+    assert rerun.sent == []
+
+    # one chunk missing from the cache: only this chunk is queried, the others keep their place
+    key = tool.RedashCache.key(171, ['T6', 'T7', 'T8'], tool.datetime.today().strftime("%d-%m-%Y"))
+    cache.conn.execute('DELETE FROM result WHERE key = ?', (key,))
+    partial = FakeRedash()
+    report = tool.running_redash(LI_TRACKING_ID, 171, partial, max_in_flight=4, cache=cache)
+    pd.testing.assert_frame_equal(report, expected())
+    assert partial.sent == [['T6', 'T7', 'T8']]
+    cache.close()
+
+    # fresh cache sends every query again
+    cache = tool.RedashCache(file_name, fresh=True)
+    fresh = FakeRedash()
+    tool.running_redash(LI_TRACKING_ID, 171, fresh, max_in_flight=4, cache=cache)
+    assert len(fresh.sent) == 5
+    cache.close()
@@ -0,0 +1,162 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fake_drive import FakeDrive
+
+
+@pytest.fixture(params=['Retail_export', 'FS_export'])
+def tool(request, monkeypatch):
+    tool = pytest.importorskip(request.param)
+    monkeypatch.setattr(tool, 'BUILD_WORKERS', 2)
+    return tool
+
+
+CUR_DATE = datetime.today().strftime("%d-%m-%Y")
+
+
+def shipper_rows(name, f_id, n, shipper_id=1):
+    # rows of one shipper as merge_report gives them
+    return pd.DataFrame({
+        'Mã': [f'{name}_{k}' for k in range(n)], 'Tên khách hàng': 'kh', 'Tên đối tác': f'CO {name} {CUR_DATE}',
+        'Số điện thoại': '090', 'Địa chỉ': 'dc', 'Hướng dẫn giao hàng': 'hd', 'Lý do': 'ld',
+        'Ngày tạo đơn': '2023-01-01 08:00:00', 'Số lần giao': np.arange(n) + 1, 'Kết quả': '', 'Ghi chú': '',
+        'shipper_id': str(shipper_id), 'shipper_name_rut_gon': name, 'f_name': f'CO {name.upper()}', 'f_id': f_id})
+
+
+def reup(tool, drive, li_rows, tmp_path):
+    cant_export = tool.FrameAccumulator()
+    for rows in li_rows:
+        cant_export.append(rows)
+    done_export = tool.FrameAccumulator()
+    journal = tool.ExportJournal(str(tmp_path / 'journal.jsonl'))
+    error_export, flag = tool.reup_cant_export_file(
+        drive, cant_export, tool.WorkbookStore(), done_export, {}, 0, None, tool.DriveIndex(drive), journal)
+    journal.close()
+    return error_export, flag, done_export.concat()
+
+
+def test_reup_uploads_cant_export_files(tool, tmp_path):
+    drive = FakeDrive()
+    folder_a, folder_b = drive.add_folder('CO A'), drive.add_folder('CO B')
+
+    error_export, flag, done_export = reup(
+        tool, drive, [shipper_rows('a', folder_a, 2), shipper_rows('b', folder_b, 3)], tmp_path)
+
+    assert flag
+    assert error_export.empty
+    assert sorted(done_export['Mã']) == ['a_0', 'a_1', 'b_0', 'b_1', 'b_2']
+    assert sorted(drive.uploads) == [(f'CO a {CUR_DATE}.xlsx', folder_a), (f'CO b {CUR_DATE}.xlsx', folder_b)]
+
+
+def test_failed_reupload_goes_to_error_export(tool, tmp_path):
+    drive = FakeDrive(fail_titles=[f'CO b {CUR_DATE}.xlsx'])
+    folder_a, folder_b = drive.add_folder('CO A'), drive.add_folder('CO B')
+    # new shipper whose folder could not be created: f_id is missing, rows are not in report_dict
+    rows_c = shipper_rows('c', np.nan, 2)
+
+    error_export, flag, done_export = reup(
+        tool, drive, [shipper_rows('a', folder_a, 2), shipper_rows('b', folder_b, 3), rows_c], tmp_path)
+
+    assert not flag
+    assert sorted(error_export['Mã']) == ['b_0', 'b_1', 'b_2', 'c_0', 'c_1']
+    assert sorted(done_export['Mã']) == ['a_0', 'a_1']
+    assert drive.uploads[-1] == (f'CO a {CUR_DATE}.xlsx', folder_a)
+
+
+def pipeline_args(tool, drive, tmp_path):
+    return tool.WorkbookStore(), tool.FrameAccumulator(), tool.FrameAccumulator(), \
+        tool.ExportJournal(str(tmp_path / 'journal.jsonl'))
+
+
+def test_upload_type_1_uploads_each_file_once(tool, tmp_path):
+    drive = FakeDrive(fail_titles=[f'CO d {CUR_DATE}.xlsx'])
+    li_name = ['a', 'b', 'c', 'd', 'e']
+    folders = {name: drive.add_folder(f'CO {name.upper()}') for name in li_name}
+    # file of today uploaded by an earlier run is replaced
+    old = drive.CreateFile({'title': f'CO a {CUR_DATE}.xlsx', 'parents': [{'id': folders['a']}]})
+    old.Upload()
+    li_rows = [shipper_rows(name, folders[name], k + 1, shipper_id=k) for k, name in enumerate(li_name)]
+    # a character openpyxl cannot write (not removed by sanitize_report here): building the file of c fails
+    li_rows[2]['Ghi chú'] = 'x\x01'
+    report_full = pd.concat(li_rows, ignore_index=True)
+    report_dict = tool.ReportPartition(report_full, 'f_name')
+    store, done_export, cant_export, journal = pipeline_args(tool, drive, tmp_path)
+
+    done_export, cant_export, num_exported_folder = tool.upload_type_1(
+        drive, report_full, report_dict, done_export, cant_export, 0, store, tool.DriveIndex(drive), journal)
+    journal.close()
+
+    assert sorted(drive.uploads[1:]) == [(f'CO {name} {CUR_DATE}.xlsx', folders[name]) for name in ['a', 'b', 'e']]
+    assert old['id'] not in drive.files
+    assert [file['title'] for file in drive.children(folders['a'])] == [f'CO a {CUR_DATE}.xlsx']
+    assert num_exported_folder == 3
+    assert sorted(done_export.concat()['shipper_name_rut_gon'].unique()) == ['a', 'b', 'e']
+    # build error (c) and upload error (d) are re-tried later
+    assert sorted(cant_export.concat()['shipper_name_rut_gon'].unique()) == ['c', 'd']
+
+
+def test_upload_type_2_creates_folder_and_uploads_once(tool, tmp_path):
+    drive = FakeDrive()
+    shipper_folder_id = drive.add_folder('CO TONG')
+    existed = drive.add_folder('CO A', shipper_folder_id)
+    shipper_folder = pd.DataFrame({'f_id': [existed], 'f_name': ['CO A']})
+    li_rows = [shipper_rows(name, None, k + 1, shipper_id=k) for k, name in enumerate(['a', 'b', 'c', 'd'])]
+    li_rows[3]['Lý do'] = 'x\x01'
+    # report merged with shipper info only, as merge_report gives it
+    report_shipper = pd.concat(li_rows, ignore_index=True).drop(columns=['f_id', 'Tên đối tác', 'Kết quả', 'Ghi chú'])
+    report_shipper = report_shipper.rename(columns={'Hướng dẫn giao hàng': 'Instruction'})
+    report_shipper['Ngày tạo đơn'] = '2023-01-01T08:00:00'
+    store, done_export, cant_export, journal = pipeline_args(tool, drive, tmp_path)
+
+    li_new_shipper_id, li_new_folder_name, li_new_folder_link, done_export, cant_export = tool.upload_type_2(
+        drive, report_shipper, shipper_folder, shipper_folder_id, store, done_export, cant_export, journal)
+    journal.close()
+
+    # one folder and one file for each new shipper (b, c), shipper a has its folder, d cannot be built
+    assert sorted(drive.folders[2:]) == [('CO B', shipper_folder_id), ('CO C', shipper_folder_id)]
+    new_folders = {file['title']: file['id'] for file in drive.children(shipper_folder_id)}
+    assert sorted(drive.uploads) == [(f'CO b {CUR_DATE}.xlsx', new_folders['CO B']),
+                                     (f'CO c {CUR_DATE}.xlsx', new_folders['CO C'])]
+    assert sorted(li_new_folder_name) == ['CO B', 'CO C']
+    assert sorted(li_new_shipper_id) == ['1', '2']
+    assert sorted(done_export.concat()['f_id'].unique()) == sorted([new_folders['CO B'], new_folders['CO C']])
+    assert cant_export.concat()['shipper_name_rut_gon'].unique().tolist() == ['d']
+
+
+def test_new_shipper_uploaded_by_earlier_run_is_skipped(tool, tmp_path):
+    drive = FakeDrive()
+    shipper_folder_id = drive.add_folder('CO TONG')
+    # a folder with no report: the outer merge of upload_type_2 makes 'Số lần giao' float
+    shipper_folder = pd.DataFrame({'f_id': [drive.add_folder('CO Z', shipper_folder_id)], 'f_name': ['CO Z']})
+    rows = shipper_rows('b', None, 3)
+    report_shipper = rows.drop(columns=['f_id', 'Tên đối tác', 'Kết quả', 'Ghi chú']).rename(
+        columns={'Hướng dẫn giao hàng': 'Instruction'})
+    report_shipper['Ngày tạo đơn'] = '2023-01-01T08:00:00'
+    store, done_export, cant_export, journal = pipeline_args(tool, drive, tmp_path)
+    tool.upload_type_2(drive, report_shipper, shipper_folder, shipper_folder_id, store, done_export, cant_export, journal)
+    journal.close()
+    assert len(drive.uploads) == 1
+
+    # rerun: the folder of b exists, so b is a type 1 shipper with int 'Số lần giao'
+    folder_b = [file['id'] for file in drive.children(shipper_folder_id) if file['title'] == 'CO B'][0]
+    report_full = shipper_rows('b', folder_b, 3)
+    report_dict = tool.ReportPartition(report_full, 'f_name')
+    store, done_export, cant_export, journal = pipeline_args(tool, drive, tmp_path)
+    done_export, cant_export, _ = tool.upload_type_1(
+        drive, report_full, report_dict, done_export, cant_export, 0, store, tool.DriveIndex(drive), journal)
+    journal.close()
+
+    assert len(drive.uploads) == 1
+    assert len(done_export) == 3
+    assert len(cant_export) == 0
+
+
+def test_report_hash_ignores_number_dtype(tool):
+    rows = shipper_rows('a', 'f', 3)
+    float_rows = rows.astype({'Số lần giao': 'float64', 'Lý do': 'category'})
+    assert tool.report_hash(rows) == tool.report_hash(float_rows)
+    float_rows.loc[1, 'Số lần giao'] = 5
+    assert tool.report_hash(rows) != tool.report_hash(float_rows)